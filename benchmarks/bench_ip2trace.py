@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# Benchmarks for ip2trace against a simulated network, so that they run without root or network access.
+# The raw ICMP sockets are replaced by FakeSocket objects. Their replies come from FakeNetwork, which places every destination behind a chain of routers with a latency per hop, random loss and a per-router ICMP rate limit.
+#
+# Usage: python3 benchmarks/bench_ip2trace.py [--workload all] [--traces 200] [--hops 12] [--json]
+from __future__ import print_function
+import argparse
+import collections
+import contextlib
+import gc
+import heapq
+import io
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import zlib
+try:
+    import resource
+except ImportError:
+    resource = None
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import ip2trace
+
+workloads = ['checksum', 'parse', 'single', 'parallel', 'batch', 'geo', 'output', 'startup']
+
+class FakeSocket:
+    # Stands in for a raw IPv4 ICMP socket. The network thread queues the replies, and one byte sits in a socketpair while the queue is not empty, so select() and add_reader() work as usual.
+    # Like the receive buffer of a raw socket, the queue holds at most queue_size replies.
+    queue_size = 4096
+    family = socket.AF_INET
+    type = socket.SOCK_RAW
+    proto = socket.IPPROTO_ICMP
+
+    def __init__(self, network):
+        self.network = network
+        self.ttl = 64
+        self.packets = collections.deque()
+        self.lock = threading.Lock()
+        self.reader, self.writer = socket.socketpair()
+
+    def setsockopt(self, level, option, value):
+        if level == socket.IPPROTO_IP and option == socket.IP_TTL:
+            self.ttl = value
+
+    def sendto(self, packet, address):
+        self.network.send(self, bytes(packet), address[0], self.ttl)
+
+    def deliver(self, packet):
+        # Returns False when the queue is full
+        with self.lock:
+            if len(self.packets) >= self.queue_size:
+                return False
+            # Stamped on arrival, like the kernel does with SO_TIMESTAMPNS
+            self.packets.append((packet, ip2trace.timer()))
+            if len(self.packets) == 1:
+                self.writer.send(b'\0')
+            return True
+
+    def recvfrom_into(self, buffer, nbytes=0, flags=0):
+        length, ancillary, _, address = self.recvmsg_into([buffer])
+        return length, address
+
+    def recvmsg_into(self, buffers, ancbufsize=0, flags=0):
+        with self.lock:
+            if len(self.packets) == 0:
+                raise BlockingIOError()
+            packet, arrival_time = self.packets.popleft()
+            if len(self.packets) == 0:
+                self.reader.recv(1)
+        buffers[0][:len(packet)] = packet
+        ancillary = []
+        if ancbufsize > 0:
+            ancillary.append((socket.SOL_SOCKET, ip2trace.SO_TIMESTAMPNS, ip2trace.timespec.pack(int(arrival_time), int(arrival_time % 1 * 1e9))))
+        # The source address is read back from the IP header, like a raw socket reports it
+        return len(packet), ancillary, 0, (socket.inet_ntoa(packet[12:16]), 0)
+
+    def fileno(self):
+        return self.reader.fileno()
+
+    def setblocking(self, flag):
+        pass
+
+    def close(self):
+        self.reader.close()
+        self.writer.close()
+
+class FakeNetwork:
+    # Every destination is hops routers away. A probe with a TTL below that gets a Time Exceeded from the router at that distance, the others an echo reply from the destination.
+    # latency is in milliseconds per hop and each way, loss is the probability that a probe or its reply is lost, icmp_rate the number of ICMP messages a router sends per second (None for no limit).
+    def __init__(self, hops=12, latency=0.2, loss=0.0, icmp_rate=None, seed=1):
+        self.hops = hops
+        self.latency = latency
+        self.loss = loss
+        self.icmp_rate = icmp_rate
+        self.random = random.Random(seed)
+        self.buckets = {}
+        self.events = []
+        self.condition = threading.Condition()
+        self.probes = 0
+        self.replies = 0
+        self.dropped = 0
+        self.late = 0
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    def open_socket(self, family):
+        if family != socket.AF_INET:
+            print("The simulated network only carries IPv4.")
+            sys.exit()
+        return FakeSocket(self)
+
+    def router(self, destination_ip, ttl):
+        # A different public-looking address for every hop of every destination, so that geolocation sees many addresses
+        value = zlib.crc32('{}/{}'.format(destination_ip, ttl).encode()) & 0xffffffff
+        return socket.inet_ntoa(struct.pack("!I", (value % 0xdf000000) + 0x01000000))
+
+    def allowed(self, router_ip, now):
+        # Token bucket per router, holding up to a tenth of a second of ICMP messages
+        if self.icmp_rate is None:
+            return True
+        burst = max(self.icmp_rate / 10.0, 1)
+        tokens, last_time = self.buckets.get(router_ip, (burst, now))
+        tokens = min(burst, tokens + (now - last_time) * self.icmp_rate)
+        if tokens < 1:
+            self.buckets[router_ip] = (tokens, now)
+            return False
+        self.buckets[router_ip] = (tokens - 1, now)
+        return True
+
+    def send(self, fake_socket, packet, destination_ip, ttl):
+        now = ip2trace.timer()
+        with self.condition:
+            self.probes += 1
+            if self.loss > 0 and self.random.random() < self.loss:
+                return
+            destination = socket.inet_aton(destination_ip)
+            if ttl < self.hops:
+                source_ip = self.router(destination_ip, ttl)
+                if self.allowed(source_ip, now) is False:
+                    return
+                quoted = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(packet), 0, 0, 1, socket.IPPROTO_ICMP, 0, b'\0\0\0\0', destination) + packet[:8]
+                message = struct.pack("!BBHI", ip2trace.ICMP_TIME_EXCEEDED, 0, 0, 0) + quoted
+                distance = ttl
+            else:
+                source_ip = destination_ip
+                message = struct.pack("!BBH", ip2trace.ICMP_ECHO_REPLY, 0, 0) + packet[4:]
+                distance = self.hops
+            source = socket.inet_aton(source_ip)
+            reply = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(message), 0, 0, 64, socket.IPPROTO_ICMP, 0, source, b'\x7f\0\0\1') + message
+            heapq.heappush(self.events, (now + 2 * distance * self.latency / 1000, self.replies, fake_socket, reply))
+            self.replies += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.events) == 0 or self.events[0][0] > ip2trace.timer():
+                    self.condition.wait(self.events[0][0] - ip2trace.timer() if len(self.events) > 0 else None)
+                due = []
+                now = ip2trace.timer()
+                while len(self.events) > 0 and self.events[0][0] <= now:
+                    due.append(heapq.heappop(self.events))
+            for deliver_time, order, fake_socket, reply in due:
+                try:
+                    if fake_socket.deliver(reply) is False:
+                        # A full receive buffer loses the reply, as on a real host
+                        self.dropped += 1
+                except OSError:
+                    # Replies that arrive after the trace has closed its socket
+                    self.late += 1
+
+def destinations(count):
+    return ['11.{}.{}.{}'.format(i >> 16 & 0xff, i >> 8 & 0xff, i & 0xff) for i in range(1, count + 1)]
+
+def max_rss():
+    # Peak resident set size of the process in kilobytes, None where the resource module is missing
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+    return rss
+
+def measure(name, network, run, unit):
+    # Runs the workload once and returns its throughput. run returns the number of units it processed.
+    gc.collect()
+    probes = network.probes if network is not None else 0
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    count = run()
+    wall = time.perf_counter() - start_wall
+    cpu = time.process_time() - start_cpu
+    result = {'workload': name, 'unit': unit, 'count': count, 'seconds': round(wall, 4), 'per_second': round(count / wall, 1), 'cpu_ms_per_unit': round(cpu * 1000 / count, 4), 'max_rss_kb': max_rss()}
+    if network is not None:
+        result['probes_per_second'] = round((network.probes - probes) / wall, 1)
+    return result
+
+def trace_all(targets, args, parallel):
+    for destination_server in targets:
+        t = ip2trace.Traceroute(destination_server, args.database, args.hops + 2, None, args.all, parallel)
+        for hop in t.trace():
+            pass
+    return len(targets)
+
+def batch_all(targets, args, enrich=False):
+    count = 0
+    for t in ip2trace.traceroute_many(targets, args.database, args.hops + 2, None, args.all, args.concurrency, enrich=enrich):
+        t.get_path()
+        count += 1
+    return count
+
+def write_all(paths, args):
+    # The writers get the hops of traces that have already completed, so that only the output is measured
+    count = 0
+    stream = io.StringIO()
+    with contextlib.redirect_stdout(stream):
+        for writer in (ip2trace.TextWriter(), ip2trace.JsonLinesWriter(stream), ip2trace.CsvWriter(stream)):
+            for t, path in paths:
+                writer.start_trace(t)
+                for hop in path:
+                    writer.write_hop(t, hop)
+                    count += 1
+                writer.end_trace(t)
+    return count
+
+def start_all(arguments, number):
+    # Starts a new interpreter number times, as the ip2tracepy entry point does. The CPU time is that of the child processes.
+    command = [sys.executable, '-c', 'import sys, ip2trace; sys.argv[0] = "ip2tracepy"; ip2trace.main()'] + arguments
+    environment = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(ip2trace.__file__)))
+    for i in range(number):
+        subprocess.call(command, env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return number
+
+def child_cpu():
+    if resource is None:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+def startup(name, arguments, number):
+    start_cpu = child_cpu()
+    result = measure(name, None, lambda: start_all(arguments, number), 'run')
+    result['cpu_ms_per_unit'] = round((child_cpu() - start_cpu) * 1000 / number, 4)
+    return result
+
+def micro(name, statement, number):
+    seconds = min(timeit.repeat(statement, number=number, repeat=3))
+    return {'workload': name, 'unit': 'call', 'count': number, 'seconds': round(seconds, 4), 'per_second': round(number / seconds, 1), 'cpu_ms_per_unit': round(seconds * 1000 / number, 6), 'max_rss_kb': max_rss()}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ip2trace against a simulated network.')
+    parser.add_argument('--workload', default='all', choices=['all'] + workloads)
+    parser.add_argument('--traces', default=200, type=int, help='Number of traces per workload. (Default: 200)')
+    parser.add_argument('--hops', default=12, type=int, help='Number of hops to every destination. (Default: 12)')
+    parser.add_argument('--latency', default=0.2, type=float, help='Milliseconds of latency per hop and direction. (Default: 0.2)')
+    parser.add_argument('--loss', default=0.0, type=float, help='Probability of losing a probe. (Default: 0)')
+    parser.add_argument('--icmp-rate', type=float, help='ICMP messages per second a router sends. (Default: no limit)')
+    parser.add_argument('--concurrency', default=100, type=int, help='Traces at once in the batch workloads. (Default: 100)')
+    parser.add_argument('--timeout', default=50, type=float, help='Milliseconds to wait for a hop before it has RTTs. (Default: 50)')
+    parser.add_argument('--database', help='IP2Location BIN database. (Default: the LITE DB1 installed with ip2trace)')
+    parser.add_argument('--all', action='store_true', help='Look up all the columns of the BIN database.')
+    parser.add_argument('--startup-target', help='Destination traced with --path-cache --incremental by the startup workload. Needs root. (Default: none)')
+    parser.add_argument('--path-cache', default='bench_path_cache.db', help='Path cache file of the startup workload. (Default: bench_path_cache.db)')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON.')
+    args = parser.parse_args()
+
+    network = FakeNetwork(args.hops, args.latency, args.loss, args.icmp_rate)
+    ip2trace.open_icmp_socket = network.open_socket
+    ip2trace.reverse_resolver.enabled = False
+    ip2trace.timeout_policy.initial = args.timeout
+    ip2trace.timeout_policy.minimum = min(args.timeout, ip2trace.timeout_policy.minimum)
+    targets = destinations(args.traces)
+    selected = workloads if args.workload == 'all' else [args.workload]
+    results = []
+
+    if 'checksum' in selected:
+        packet = bytearray(64)
+        results.append(micro('calculate_checksum', lambda: ip2trace.calculate_checksum(packet), 200000))
+        results.append(micro('update_checksum', lambda: ip2trace.update_checksum(0x1234, 0, 0x5678), 200000))
+    if 'parse' in selected:
+        quoted = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 28, 0, 0, 1, socket.IPPROTO_ICMP, 0, bytes(4), bytes(4)) + struct.pack("!BBHHH", ip2trace.ICMP_ECHO, 0, 0, 7, 9)
+        reply = bytearray(struct.pack("!BBHHHBBH4s4s", 0x45, 0, 56, 0, 0, 64, socket.IPPROTO_ICMP, 0, bytes(4), bytes(4)) + struct.pack("!BBHI", ip2trace.ICMP_TIME_EXCEEDED, 0, 0, 0) + quoted + bytes(1444))
+        identifiers = {7: None}
+        results.append(micro('parse_icmp_reply', lambda: ip2trace.parse_icmp_reply(reply, socket.AF_INET, 56, identifiers), 200000))
+    if 'single' in selected:
+        single = targets[:max(args.traces // 10, 1)]
+        results.append(measure('sequential trace', network, lambda: trace_all(single, args, False), 'trace'))
+    if 'parallel' in selected:
+        results.append(measure('parallel trace', network, lambda: trace_all(targets, args, True), 'trace'))
+    if 'batch' in selected:
+        results.append(measure('batch', network, lambda: batch_all(targets, args), 'trace'))
+    if 'geo' in selected:
+        # Every hop misses the geolocation cache
+        maxsize = ip2trace.geo_cache.maxsize
+        ip2trace.geo_cache.maxsize = 0
+        ip2trace.geo_cache.clear()
+        args.all = True
+        results.append(measure('batch, uncached geolocation', network, lambda: batch_all(destinations(args.traces * 2)[args.traces:], args), 'trace'))
+        ip2trace.geo_cache.clear()
+        results.append(measure('batch, uncached, --enrich', network, lambda: batch_all(destinations(args.traces * 2)[args.traces:], args, True), 'trace'))
+        ip2trace.geo_cache.maxsize = maxsize
+    if 'output' in selected:
+        paths = [(t, t.get_path()) for t in ip2trace.traceroute_many(targets, args.database, args.hops + 2, None, args.all, args.concurrency)]
+        results.append(measure('writers', None, lambda: write_all(paths, args), 'hop'))
+    if 'startup' in selected:
+        # Real processes, so these do not use the simulated network. Run twice to time the start-up of a trace against a warm path cache.
+        results.append(startup('startup, --version', ['--version'], 20))
+        if args.startup_target is not None:
+            results.append(startup('startup, cached path trace', ['--path-cache', args.path_cache, '--incremental', '-n', args.startup_target], 20))
+
+    if args.json:
+        print(json.dumps({'network': {'hops': args.hops, 'latency': args.latency, 'loss': args.loss, 'icmp_rate': args.icmp_rate, 'dropped_replies': network.dropped, 'late_replies': network.late}, 'results': results}, indent=2))
+        return
+    print("{:<30} {:>10} {:>14} {:>14} {:>16} {:>12}".format('workload', 'count', 'per second', 'probes/s', 'cpu ms/unit', 'max rss kb'))
+    for result in results:
+        print("{:<30} {:>10} {:>14} {:>14} {:>16} {:>12}".format(result['workload'], result['count'], '{} {}s'.format(result['per_second'], result['unit']), result.get('probes_per_second', '-'), result['cpu_ms_per_unit'], result['max_rss_kb'] or '-'))
+
+if __name__ == '__main__':
+    main()
@@ -2,47 +2,76 @@ from __future__ import print_function
 import socket
 import struct
 import os
-import platform
+import math
 import time
 import sys
 import select
-import argparse
-import IP2Location
-from random import choices
+import io
+import json
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+from collections import namedtuple, OrderedDict, deque
 from re import match
-from shutil import copyfile
+# IP2Location, argparse, asyncio, csv, ctypes, multiprocessing, sqlite3, random and shutil are imported where they are first needed, so that ip2tracepy --version and traces that do not use them start quickly.
 
 ICMP_ECHO = 8
 ICMP_V6_ECHO = 128
 ICMP_ECHO_REPLY = 0
 ICMP_V6_ECHO_REPLY = 129
 ICMP_TIME_EXCEEDED = 11
+ICMP_V6_TIME_EXCEEDED = 3
+ICMP_DEST_UNREACHABLE = 3
+ICMP_V6_DEST_UNREACHABLE = 1
+IPPROTO_ICMPV6 = 58
+# Linux raw socket options to drop unwanted ICMP types in the kernel
+SOL_RAW = 255
+ICMP_FILTER = 1
+ICMP6_FILTER = 1
+# Linux socket option to run a classic BPF program on every packet before it is queued
+SO_ATTACH_FILTER = 26
+# Linux socket option that stamps every packet with its arrival time in the kernel, read back as a struct timespec from the ancillary data
+SO_TIMESTAMPNS = 35
+# Pseudo ICMP type for the SYN-ACK or RST a destination answers a TCP probe with
+TCP_RESPONSE = 256
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+# Destination ports of the UDP and TCP probes unless --port is given
+DEFAULT_UDP_PORT = 33434
+DEFAULT_TCP_PORT = 80
+# TCP probes are sent from the ephemeral ports, so that a SYN-ACK or RST meant for a service on the host is not taken for an answer
+TCP_PORT_BASE = 49152
+TCP_PORT_COUNT = 16384
+probe_methods = ['icmp', 'udp', 'tcp']
+# Light covers about 200 km per millisecond in optical fibre, so a router cannot be farther away than 100 km per millisecond of RTT
+FIBRE_KM_PER_MS = 200.0
+EARTH_RADIUS_KM = 6371.0
 
 ip2location_result_fields = ['country_short', 'country_long', 'region', 'city', 'isp', 'latitude', 'longitude', 'domain', 'zipcode', 'timezone', 'netspeed', 'idd_code', 'area_code', 'weather_code', 'weather_name', 'mcc', 'mnc', 'mobile_brand', 'elevation', 'usage_type', 'address_type', 'category', 'district', 'asn', 'as_name', ]
+Hop = namedtuple('Hop', ['ttl', 'ip', 'rtts', 'hostname', 'geo'])
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
 ip2location_outputs_reference = ['country_code', 'country_name', 'region_name', 'city_name', 'isp', 'latitude', 'longitude', 'domain', 'zip_code', 'time_zone', 'net_speed', 'idd_code', 'area_code', 'weather_station_code', 'weather_station_name', 'mcc', 'mnc', 'mobile_brand', 'elevation', 'usage_type', 'address_type', 'category', 'district', 'asn', 'as_name', ]
+# Output column of every IP2Location record field
+ip2location_output_fields = dict(zip(ip2location_outputs_reference, ip2location_result_fields))
+# Columns derived from the path by --enrich
+enrichment_columns = ['distance_km', 'rtt_plausible']
 
-if platform.system() == 'Windows':
+if sys.platform.startswith('win32'):
     # Windows IPv6 compatibility
     socket.IPPROTO_IPV6 = 41
     socket.IPPROTO_ICMPV6 = 58
-    MIN_SLEEP = 500
     # Define BIN database default path
     default_path = os.path.expanduser('~') + os.sep + "Documents" + os.sep
 else:
-    MIN_SLEEP = 100
     # Define BIN database default path
     default_path = '/usr/local/share/ip2location/'
     # default_path = '/usr/share/ip2location/'
-
-# Now we copy the BIN database to default_path here instead of doing it duing installation as pip kept copied to wrong location.
-if (os.path.isfile(default_path + "IP2LOCATION-LITE-DB1.IPV6.BIN") == False):
-    try:
-        # create the dir is not exist
-        if (os.path.exists(default_path) is False):
-            os.mkdir(default_path)
-        copyfile(os.path.dirname(os.path.realpath(__file__)) + os.sep + "data" + os.sep + "IP2LOCATION-LITE-DB1.IPV6.BIN", default_path + "IP2LOCATION-LITE-DB1.IPV6.BIN")
-    except PermissionError as e:
-        sys.exit("Root permission is required. Please rerun it as 'sudo ip2tracepy' in Linux, or obtain administrator permission in Windows.")
+# The DB1 database shipped with the package, used when no database is installed in default_path
+bundled_path = os.path.dirname(os.path.realpath(__file__)) + os.sep + "data" + os.sep
 
 if sys.platform.startswith('win32'):
     # timer = time.clock
@@ -53,26 +82,59 @@ if sys.platform.startswith('win32'):
 else:
     timer = time.time
 
+identifier_counter = (os.getpid() - 1) & 0xffff
+# Identifiers are handed out from identifier_base to identifier_base + identifier_count - 1
+identifier_base = 0
+identifier_count = 0x10000
+echo_identifier_seq = struct.Struct("!HH")
+echo_header = struct.Struct("!BBHHH")
+udp_port_length = struct.Struct("!HxxH")
+tcp_port_seq = struct.Struct("!HxxI")
+tcp_header = struct.Struct("!HHIIBBHHH")
+timespec = struct.Struct("@ll")
+sock_filter = struct.Struct("@HBBI")
+# The kernel timestamps are wall clock times, like timer() on Linux
+kernel_timestamps = sys.platform.startswith('linux') and hasattr(socket.socket, 'recvmsg_into')
+timestamp_space = socket.CMSG_SPACE(timespec.size) if kernel_timestamps else 0
+# Flag to read a socket without blocking while sends through it still block. Windows has no MSG_DONTWAIT, select() is asked there instead.
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', None)
+
 def calculate_checksum(packet):
-    countTo = (len(packet) // 2) * 2
-    count = 0
-    sum = 0
-    while count < countTo:
-        if sys.byteorder == "little":
-            loByte = packet[count]
-            hiByte = packet[count + 1]
-        else:
-            loByte = packet[count + 1]
-            hiByte = packet[count]
-        sum = sum + (hiByte * 256 + loByte)
-        count += 2
-    if countTo < len(packet):
-        sum += packet[count]
-    sum = (sum >> 16) + (sum & 0xffff)
-    sum += (sum >> 16)
-    answer = ~sum & 0xffff
-    answer = socket.htons(answer)
-    return answer
+    # Internet checksum (RFC 1071) of the packet, as a big-endian 16-bit value.
+    # As 2**16 = 1 (mod 0xffff), the ones' complement sum of the 16-bit words is the whole packet read as one number modulo 0xffff, which Python computes in C.
+    if len(packet) % 2 == 1:
+        packet = bytes(packet) + b'\0'
+    total = int.from_bytes(packet, 'big')
+    sum = total % 0xffff
+    if sum == 0 and total != 0:
+        sum = 0xffff
+    return ~sum & 0xffff
+
+def update_checksum(checksum, old_value, new_value):
+    # Incremental checksum update for one changed 16-bit field, HC' = ~(~HC + ~m + m') from RFC 1624
+    sum = (~checksum & 0xffff) + (~old_value & 0xffff) + new_value
+    sum = (sum & 0xffff) + (sum >> 16)
+    sum = (sum & 0xffff) + (sum >> 16)
+    return ~sum & 0xffff
+
+def distance_km(a, b):
+    # Great-circle distance between two (latitude, longitude) pairs in degrees, with the haversine formula
+    latitude_a, longitude_a = math.radians(a[0]), math.radians(a[1])
+    latitude_b, longitude_b = math.radians(b[0]), math.radians(b[1])
+    h = math.sin((latitude_b - latitude_a) / 2) ** 2 + math.cos(latitude_a) * math.cos(latitude_b) * math.sin((longitude_b - longitude_a) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(min(math.sqrt(h), 1.0))
+
+def record_location(record):
+    # (latitude, longitude) of an IP2Location record, None when the BIN has no coordinates or does not know where the IP address is
+    if record is None:
+        return None
+    try:
+        location = (float(record.__dict__['latitude']), float(record.__dict__['longitude']))
+    except (KeyError, TypeError, ValueError):
+        return None
+    if location == (0.0, 0.0):
+        return None
+    return location
 
 def is_ipv4(hostname):
     pattern = r'^([0-9]{1,3}[.]){3}[0-9]{1,3}$'
@@ -96,6 +158,231 @@ def to_ip(hostname):
         return hostname
     return socket.gethostbyname(hostname)
 
+def parse_icmp_reply(packet_data, family, length=None, identifiers=None, method='icmp'):
+    # Returns the ICMP type, identifier and sequence number of the probe a reply belongs to, or None for any other packet.
+    # packet_data is usually a preallocated receive buffer holding length bytes. It is read in place and never sliced.
+    # Time Exceeded and Destination Unreachable messages quote the original datagram, so the identifier and sequence number are read from the quoted probe:
+    # the identifier and sequence number of an ICMP echo request, the source port and payload length of a UDP datagram or the source port and sequence number of a TCP SYN.
+    # Replies whose identifier is not in identifiers are dropped before anything is built.
+    if length is None:
+        length = len(packet_data)
+    if family == socket.AF_INET:
+        # Raw IPv4 sockets deliver the IP header, raw IPv6 sockets do not
+        if length < 20:
+            return None
+        offset = (packet_data[0] & 0x0f) * 4
+        icmp_protocol = socket.IPPROTO_ICMP
+        echo_type = ICMP_ECHO
+        echo_reply_type = ICMP_ECHO_REPLY
+        error_types = (ICMP_TIME_EXCEEDED, ICMP_DEST_UNREACHABLE)
+    else:
+        offset = 0
+        icmp_protocol = IPPROTO_ICMPV6
+        echo_type = ICMP_V6_ECHO
+        echo_reply_type = ICMP_V6_ECHO_REPLY
+        error_types = (ICMP_V6_TIME_EXCEEDED, ICMP_V6_DEST_UNREACHABLE)
+    if length < offset + 8:
+        return None
+    if method == 'udp':
+        protocol = socket.IPPROTO_UDP
+    elif method == 'tcp':
+        protocol = socket.IPPROTO_TCP
+    else:
+        protocol = icmp_protocol
+    icmp_type = packet_data[offset]
+    if icmp_type == echo_reply_type:
+        if protocol != icmp_protocol:
+            return None
+        probe = offset
+    elif icmp_type in error_types:
+        quoted = offset + 8
+        # The quoted datagram must be one of our probes
+        if family == socket.AF_INET:
+            if length < quoted + 20 or packet_data[quoted + 9] != protocol:
+                return None
+            probe = quoted + (packet_data[quoted] & 0x0f) * 4
+        else:
+            # The quoted IPv6 header is 40 bytes long, the probes carry no extension headers
+            if length < quoted + 40 or packet_data[quoted + 6] != protocol:
+                return None
+            probe = quoted + 40
+        if length < probe + 8 or (protocol == icmp_protocol and packet_data[probe] != echo_type):
+            return None
+    else:
+        return None
+    if protocol == icmp_protocol:
+        probe += 4
+        fields = echo_identifier_seq
+    elif protocol == socket.IPPROTO_UDP:
+        fields = udp_port_length
+    else:
+        fields = tcp_port_seq
+    if identifiers is not None and (packet_data[probe] << 8 | packet_data[probe + 1]) not in identifiers:
+        return None
+    identifier, seq_no = fields.unpack_from(packet_data, probe)
+    if protocol == socket.IPPROTO_UDP:
+        # The UDP length includes the 8 byte header
+        seq_no -= 8
+    return icmp_type, identifier, seq_no
+
+def parse_tcp_reply(packet_data, family, length=None, identifiers=None):
+    # Returns TCP_RESPONSE, the identifier and the sequence number of the TCP probe a SYN-ACK or RST answers, or None for any other segment. The trace checks that it comes from the destination.
+    # The identifier is our source port, now the destination port, and the segment acknowledges the probe sequence number plus one.
+    if length is None:
+        length = len(packet_data)
+    if family == socket.AF_INET:
+        if length < 20:
+            return None
+        offset = (packet_data[0] & 0x0f) * 4
+    else:
+        offset = 0
+    if length < offset + 20:
+        return None
+    flags = packet_data[offset + 13]
+    if flags & TCP_ACK == 0 or flags & (TCP_SYN | TCP_RST) == 0:
+        return None
+    identifier = packet_data[offset + 2] << 8 | packet_data[offset + 3]
+    if identifiers is not None and identifier not in identifiers:
+        return None
+    ack_no = struct.unpack_from("!I", packet_data, offset + 8)[0]
+    return TCP_RESPONSE, identifier, (ack_no - 1) & 0xffffffff
+
+def read_reply(reply_socket, buffer, identifiers=None, method='icmp', flags=0):
+    # Reads one packet from a raw socket into buffer. Returns the ICMP type, identifier, sequence number, source address and receive time of a reply to one of our probes, or None for any other packet.
+    # On Linux the receive time is when the kernel got the packet, so the RTTs do not include the time replies wait in the socket while other traces are handled.
+    receive_time = None
+    if kernel_timestamps:
+        length, ancillary, _, address = reply_socket.recvmsg_into([buffer], timestamp_space, flags)
+        for level, kind, data in ancillary:
+            if level == socket.SOL_SOCKET and kind == SO_TIMESTAMPNS and len(data) >= timespec.size:
+                seconds, nanoseconds = timespec.unpack_from(data)
+                receive_time = seconds + nanoseconds / 1e9
+    else:
+        length, address = reply_socket.recvfrom_into(buffer, 0, flags)
+    parse_time = timer()
+    if receive_time is None:
+        receive_time = parse_time
+    if reply_socket.proto == socket.IPPROTO_TCP:
+        reply = parse_tcp_reply(buffer, reply_socket.family, length, identifiers)
+    else:
+        reply = parse_icmp_reply(buffer, reply_socket.family, length, identifiers, method)
+    if metrics.enabled:
+        metrics.observe('parse', timer() - parse_time)
+    if reply is None:
+        return None
+    return reply[0], reply[1], reply[2], address[0], receive_time
+
+def read_replies(reply_socket, buffer, identifiers=None, method='icmp'):
+    # Yields every reply to our probes queued in a raw socket, without waiting for more
+    while True:
+        if MSG_DONTWAIT is None and len(select.select([reply_socket], [], [], 0)[0]) == 0:
+            return
+        try:
+            reply = read_reply(reply_socket, buffer, identifiers, method, MSG_DONTWAIT or 0)
+        except (BlockingIOError, InterruptedError):
+            return
+        if reply is not None:
+            yield reply
+
+def identifier_range(method='icmp'):
+    # (first identifier, number of identifiers) of the process for the probe method. The identifier of a TCP probe is its source port, so the range is scaled into the ephemeral ports.
+    if method == 'tcp':
+        low = TCP_PORT_BASE + identifier_base * TCP_PORT_COUNT // 0x10000
+        high = TCP_PORT_BASE + (identifier_base + identifier_count) * TCP_PORT_COUNT // 0x10000
+        return low, max(high - low, 1)
+    return identifier_base, identifier_count
+
+def next_identifier(method='icmp'):
+    # Every trace gets its own ICMP identifier (TCP source port) so that traces sharing a socket can tell their replies apart
+    global identifier_counter
+    low, count = identifier_range(method)
+    identifier_counter = (identifier_counter + 1) % identifier_count
+    return low + identifier_counter % count
+
+def set_identifier_range(base, count):
+    # Raw sockets receive the replies to every process on the host, so processes tracing at the same time need disjoint identifiers
+    global identifier_base, identifier_count, identifier_counter
+    identifier_base = base
+    identifier_count = count
+    identifier_counter = os.getpid() % count
+
+def identifier_filter(family, protocol, method, low, count):
+    # Classic BPF program, as (code, jt, jf, k) instructions, that only accepts the replies to probes with an identifier from low to low + count - 1.
+    # Raw IPv4 sockets see the IP header and raw IPv6 sockets start after it, so X is first set to the offset of the ICMP or TCP header.
+    program = [(0xb1, 0, 0, 0) if family == socket.AF_INET else (0x01, 0, 0, 0)]  # X = 4 * (IHL) or 0
+    if protocol == socket.IPPROTO_TCP:
+        # The SYN-ACK or RST is sent to our source port
+        program.append((0x48, 0, 0, 2))  # A = destination port
+    else:
+        if family == socket.AF_INET:
+            echo_reply_type = ICMP_ECHO_REPLY
+            quoted = [(0x50, 0, 0, 8), (0x54, 0, 0, 0x0f), (0x64, 0, 0, 2), (0x0c, 0, 0, 0), (0x04, 0, 0, 8), (0x07, 0, 0, 0)]  # X += 8 + 4 * (quoted IHL)
+        else:
+            echo_reply_type = ICMP_V6_ECHO_REPLY
+            quoted = [(0x01, 0, 0, 48)]  # X = 8 + 40
+        # Echo replies carry the identifier, and only answer ICMP probes. Error messages quote the probe, which carries it.
+        program.append((0x50, 0, 0, 0))  # A = ICMP type
+        program.append((0x15, len(quoted) + 2 if method == 'icmp' else len(quoted) + 6, 0, echo_reply_type))  # echo reply: load its identifier, or drop
+        program += quoted
+        program.append((0x48, 0, 0, 4 if method == 'icmp' else 0))  # A = identifier or source port of the quoted probe
+        program.append((0x05, 0, 0, 1))  # skip the echo reply load
+        program.append((0x48, 0, 0, 4))  # A = identifier of the echo reply
+    program += [(0x35, 0, 2, low), (0x35, 1, 0, low + count), (0x06, 0, 0, 0xffff), (0x06, 0, 0, 0)]  # accept low <= A < low + count, drop the rest
+    return program
+
+def attach_identifier_filter(reply_socket, method, low, count):
+    # Raw sockets receive the replies to every process on the host. A process using part of the identifiers has the kernel drop the replies to the others, instead of reading and parsing them.
+    import ctypes
+    program = identifier_filter(reply_socket.family, reply_socket.proto, method, low, count)
+    code = ctypes.create_string_buffer(b''.join(sock_filter.pack(*instruction) for instruction in program))
+    reply_socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, struct.pack("@HP", len(program), ctypes.addressof(code)))
+
+def open_icmp_socket(family):
+    try:
+        if family == socket.AF_INET:
+            icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        else:
+            icmp_socket = socket.socket(socket.AF_INET6, socket.SOCK_RAW, socket.IPPROTO_ICMPV6)
+            if sys.platform.startswith('linux'):
+                icmp_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_TCLASS, 0)
+        if sys.platform.startswith('linux'):
+            # Only wake up for the replies a trace can use. Set bits block an ICMP type.
+            if family == socket.AF_INET:
+                blocked = 0xffffffff & ~(1 << ICMP_ECHO_REPLY | 1 << ICMP_DEST_UNREACHABLE | 1 << ICMP_TIME_EXCEEDED)
+                icmp_socket.setsockopt(SOL_RAW, ICMP_FILTER, struct.pack("I", blocked))
+            else:
+                blocked = [0xffffffff] * 8
+                for icmp_type in (ICMP_V6_ECHO_REPLY, ICMP_V6_DEST_UNREACHABLE, ICMP_V6_TIME_EXCEEDED):
+                    blocked[icmp_type >> 5] &= ~(1 << (icmp_type & 31))
+                icmp_socket.setsockopt(IPPROTO_ICMPV6, ICMP6_FILTER, struct.pack("8I", *blocked))
+        # Replies to a whole burst of probes can arrive before they are read, so ask for a larger receive buffer
+        icmp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        if kernel_timestamps:
+            icmp_socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except PermissionError as err:
+        raise PermissionError(err.errno, "Operation not permitted: ICMP messages can only be sent from a process running as root")
+    return icmp_socket
+
+def open_tcp_socket(family):
+    # Raw TCP socket the SYN probes are sent from. It also receives the SYN-ACK or RST of the destination, while the routers on the way answer on the ICMP socket.
+    try:
+        tcp_socket = socket.socket(family, socket.SOCK_RAW, socket.IPPROTO_TCP)
+        tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        if kernel_timestamps:
+            tcp_socket.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMPNS, 1)
+    except PermissionError as err:
+        raise PermissionError(err.errno, "Operation not permitted: TCP probes can only be sent from a process running as root")
+    return tcp_socket
+
+def source_address(family, destination_address):
+    # The local address the kernel sends to the destination from, found by connecting a UDP socket (no packet is sent)
+    udp_socket = socket.socket(family, socket.SOCK_DGRAM)
+    try:
+        udp_socket.connect(destination_address)
+        return udp_socket.getsockname()[0]
+    finally:
+        udp_socket.close()
+
 def ip_to_domain_name(hostname):
     if is_valid_ip(hostname):
         # return socket.gethostbyaddr(hostname)
@@ -108,7 +395,486 @@ def ip_to_domain_name(hostname):
     return None
 
 
+class LookupCache:
+    # Bounded LRU cache with an optional time to live (in seconds) for the entries
+    MISSING = object()
+
+    def __init__(self, maxsize=4096, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        # Returns LookupCache.MISSING when the key is not cached or has expired
+        value = self.peek(key)
+        self.count(value is not LookupCache.MISSING)
+        return value
+
+    def peek(self, key):
+        # Same as get(), without counting a hit or miss
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > timer()):
+                self.entries.move_to_end(key)
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+            return LookupCache.MISSING
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def put(self, key, value):
+        if self.maxsize <= 0:
+            return
+        expires = None
+        if self.ttl is not None:
+            expires = timer() + self.ttl
+        with self.lock:
+            self.entries[key] = (value, expires)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+def install_database():
+    # Copies the bundled BIN database to default_path, where it is picked up when no database is given. This is done by ip2tracepy --install-db rather than during installation as pip kept copying it to the wrong location.
+    from shutil import copyfile
+    if os.path.isfile(bundled_path + "IP2LOCATION-LITE-DB1.IPV6.BIN") == False:
+        print("The bundled BIN database is missing. You can download the latest free IP2Location BIN database from https://lite.ip2location.com.")
+        sys.exit()
+    try:
+        # create the dir is not exist
+        if (os.path.exists(default_path) is False):
+            os.makedirs(default_path)
+        copyfile(bundled_path + "IP2LOCATION-LITE-DB1.IPV6.BIN", default_path + "IP2LOCATION-LITE-DB1.IPV6.BIN")
+    except PermissionError as e:
+        sys.exit("Root permission is required. Please rerun it as 'sudo ip2tracepy --install-db' in Linux, or obtain administrator permission in Windows.")
+    print("Installed the IP2Location BIN database in " + default_path + "IP2LOCATION-LITE-DB1.IPV6.BIN")
+
+def resolve_database_path(database):
+    # Raises ValueError when the BIN database cannot be found
+    if (database is not None):
+        if os.path.isfile(database) == False:
+            # Now will check if the filename passed is a BIN extension or not
+            if database.upper().endswith(".BIN"):
+                # check if the given filename is under current dir or not.
+                if (os.getcwd().endswith(os.sep)):
+                    filepath = os.getcwd() + database
+                else:
+                    filepath = os.getcwd() + os.sep + database
+                # print(filepath)
+                if os.path.isfile(filepath) == False:
+                    if os.path.isfile(default_path + database) == False:
+                        raise ValueError("BIN database file not found.")
+                    else:
+                        return os.path.realpath(default_path + database)
+                else:
+                    return os.path.realpath(filepath)
+            else:
+                raise ValueError("Only BIN database is accepted. You can download the latest free IP2Location BIN database from https://lite.ip2location.com.")
+        else:
+            return os.path.realpath(database)
+    else:
+        if (os.path.isfile(default_path + "IP2LOCATION-LITE-DB1.IPV6.BIN") != False):
+            return os.path.realpath(default_path + "IP2LOCATION-LITE-DB1.IPV6.BIN")
+        elif (os.path.isfile(bundled_path + "IP2LOCATION-LITE-DB1.IPV6.BIN") != False):
+            return os.path.realpath(bundled_path + "IP2LOCATION-LITE-DB1.IPV6.BIN")
+        else:
+            raise ValueError("Missing IP2Location BIN database. Please enter 'ip2trace -h' for more information.")
+
+def open_database(database=None):
+    # Returns the resolved path and the IP2Location object of a BIN database. Each BIN is opened once per process and the object is shared by every trace.
+    # The object seeks and then reads, on the memory map as on the file, so lookups through it hold database_locks[path].
+    import IP2Location
+    with databases_lock:
+        if database in database_paths:
+            database_path = database_paths[database]
+        else:
+            database_path = resolve_database_path(database)
+            database_paths[database] = database_path
+        if database_path not in databases:
+            try:
+                # Forked workers reuse the pages of a memory-mapped database
+                databases[database_path] = IP2Location.IP2Location(database_path, 'SHARED_MEMORY')
+            except (IOError, OSError):
+                # IP2Location maps the file read-write, fall back to plain file reads when it is read-only
+                databases[database_path] = IP2Location.IP2Location(database_path)
+            database_locks[database_path] = threading.Lock()
+        return database_path, databases[database_path]
+
+def reopen_file_databases():
+    # A forked child shares the file offset of FILE_IO databases with its parent, so give it its own handles. A lock held by another thread of the parent would never be released in the child.
+    for database_path, obj in databases.items():
+        if obj.mode == 'FILE_IO':
+            obj.open(database_path)
+        database_locks[database_path] = threading.Lock()
+
+# IP2Location databases opened in this process, keyed by the resolved BIN path
+databases = {}
+database_paths = {}
+database_locks = {}
+databases_lock = threading.Lock()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reopen_file_databases)
+
+# IP2Location records shared by every trace in the process, keyed by BIN file and IP address
+geo_cache = LookupCache()
+
+class ReverseResolver:
+    # Looks up PTR names on daemon threads so that probing never waits for DNS.
+    # Answers and failures are cached separately, and a lookup gives up once its deadline (in seconds from submission) has passed.
+    def __init__(self, workers=16, timeout=2.0, cache_size=4096, ttl=3600, negative_ttl=300):
+        self.enabled = True
+        self.workers = workers
+        self.timeout = timeout
+        self.names = LookupCache(cache_size, ttl)
+        self.failures = LookupCache(cache_size, negative_ttl)
+        self.reset()
+
+    def reset(self):
+        self.requests = queue.Queue()
+        self.pending = {}
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, ip):
+        # Starts resolving the IP address in the background, unless it is cached or already in flight
+        if self.enabled is False or ip in self.pending:
+            return
+        if self.names.peek(ip) is not LookupCache.MISSING or self.failures.peek(ip) is not LookupCache.MISSING:
+            return
+        with self.lock:
+            if ip in self.pending:
+                return
+            self.pending[ip] = (threading.Event(), timer() + self.timeout)
+            if len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.worker)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+        self.requests.put(ip)
+
+    def ready(self, ip):
+        # True when resolve() would return without waiting
+        if self.enabled is False or ip is None:
+            return True
+        request = self.pending.get(ip)
+        return request is None or request[1] <= timer()
+
+    def resolve(self, ip, wait=True):
+        # Returns the PTR name of the IP address, or None when it has none or the lookup missed its deadline. Without wait, a lookup still running counts as no name.
+        # Every call counts once in the statistics of the names cache, with a cached failure as a hit.
+        if self.enabled is False:
+            return None
+        name = self.names.peek(ip)
+        if name is not LookupCache.MISSING:
+            self.names.count(True)
+            return name
+        if self.failures.peek(ip) is not LookupCache.MISSING:
+            self.names.count(True)
+            return None
+        self.names.count(False)
+        self.submit(ip)
+        request = self.pending.get(ip)
+        if request is not None and wait:
+            start_time = timer()
+            request[0].wait(max(request[1] - timer(), 0))
+            metrics.observe('dns_wait', timer() - start_time)
+        name = self.names.peek(ip)
+        if name is LookupCache.MISSING:
+            return None
+        return name
+
+    def worker(self):
+        while True:
+            ip = self.requests.get()
+            start_time = timer()
+            try:
+                name = socket.gethostbyaddr(ip)[0]
+            except (socket.herror, socket.gaierror, socket.error):
+                name = None
+            metrics.observe('dns', timer() - start_time)
+            if name is None:
+                self.failures.put(ip, True)
+            else:
+                self.names.put(ip, name)
+            with self.lock:
+                request = self.pending.pop(ip, None)
+            if request is not None:
+                request[0].set()
+
+reverse_resolver = ReverseResolver()
+
+class DestinationResolver:
+    # Reads the destinations of a batch ahead of the traces and resolves their hostnames on daemon threads, so that the select loop never waits for forward DNS.
+    # Every hostname is looked up once, and the destinations come out in input order.
+    def __init__(self, destination_servers, workers=8, lookahead=256):
+        self.destination_servers = iter(destination_servers)
+        self.workers = workers
+        self.lookahead = lookahead
+        # [destination, lookup] in input order, a lookup is [IP address or None for an unknown host, Event set once resolved]
+        self.entries = deque()
+        # Lookups by hostname
+        self.lookups = {}
+        self.requests = queue.Queue()
+        self.threads = []
+        self.exhausted = False
+
+    def fill(self):
+        while self.exhausted is False and len(self.entries) < self.lookahead:
+            try:
+                destination_server = next(self.destination_servers).strip()
+            except StopIteration:
+                self.close()
+                break
+            if destination_server == '' or destination_server.startswith('#'):
+                continue
+            if is_valid_ip(destination_server):
+                lookup = [destination_server, threading.Event()]
+                lookup[1].set()
+            elif destination_server in self.lookups:
+                lookup = self.lookups[destination_server]
+            else:
+                lookup = [None, threading.Event()]
+                if len(self.threads) < self.workers:
+                    thread = threading.Thread(target=self.worker)
+                    thread.daemon = True
+                    thread.start()
+                    self.threads.append(thread)
+                self.requests.put((destination_server, lookup))
+                self.lookups[destination_server] = lookup
+            self.entries.append((destination_server, lookup))
+
+    def pending(self):
+        # True when the next destination is still being resolved
+        self.fill()
+        return len(self.entries) > 0 and self.entries[0][1][1].is_set() is False
+
+    def get(self, wait=False):
+        # Returns (destination, IP address) for the next destination, with None as the address of an unknown host.
+        # Returns None while it is still being resolved, unless wait is set, and False once every destination has been handed out.
+        self.fill()
+        if len(self.entries) == 0:
+            return False
+        destination_server, lookup = self.entries[0]
+        if wait:
+            lookup[1].wait()
+        elif lookup[1].is_set() is False:
+            return None
+        self.entries.popleft()
+        return destination_server, lookup[0]
+
+    def close(self):
+        # Stops the threads once the queued hostnames are resolved
+        if self.exhausted is False:
+            self.exhausted = True
+            for thread in self.threads:
+                self.requests.put(None)
+
+    def worker(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            destination_server, lookup = request
+            try:
+                lookup[0] = to_ip(destination_server)
+            except socket.gaierror:
+                lookup[0] = None
+            lookup[1].set()
+
+class TimeoutPolicy:
+    # How long to wait for the replies to a hop, in milliseconds. The timeout starts at initial and then follows the RTTs seen on the earlier hops (SRTT + k * RTTVAR as in RFC 6298), kept between minimum and maximum.
+    def __init__(self, initial=500, minimum=250, maximum=2000, k=4):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.k = k
+
+    def estimator(self):
+        return RttEstimator(self)
+
+class RttEstimator:
+    def __init__(self, policy):
+        self.policy = policy
+        self.srtt = None
+        self.rttvar = None
+
+    def update(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+    def timeout(self):
+        if self.srtt is None:
+            return self.policy.initial
+        return min(max(self.srtt + self.policy.k * self.rttvar, self.policy.minimum), self.policy.maximum)
+
+class RateLimiter:
+    # Spaces out the probes sent by the whole process to a number of packets per second. A rate of None sends without pacing.
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.next_time = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, count=1):
+        # Books the next count probes and returns the number of seconds to wait before sending them
+        if self.rate is None:
+            return 0
+        with self.lock:
+            now = timer()
+            self.next_time = max(self.next_time, now)
+            delay = self.next_time - now
+            self.next_time += count / float(self.rate)
+            return delay
+
+    def wait(self, count=1):
+        delay = self.reserve(count)
+        if delay > 0:
+            time.sleep(delay)
+            metrics.observe('rate_limit', delay)
+
+class Metrics:
+    # Time spent in each phase of the traces (send, wait, parse, dns, dns_wait, geolocation, output, rate_limit and trace), in seconds, with event counters.
+    # Nothing is recorded until enabled is set, so probing only pays for one attribute check per phase.
+    buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10)
+
+    def __init__(self):
+        self.enabled = False
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        # Every phase holds its count, total, max and a count per histogram bucket
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        # Cache hits and misses merged from worker processes
+        self.worker_caches = {'geo': [0, 0], 'dns': [0, 0]}
+
+    def add_callback(self, callback):
+        # callback(phase, seconds) is called for every timing, from the thread that recorded it
+        self.callbacks.append(callback)
+        self.enabled = True
+
+    def remove_callback(self, callback):
+        self.callbacks.remove(callback)
+
+    def observe(self, phase, seconds):
+        if self.enabled is False:
+            return
+        with self.lock:
+            if phase not in self.phases:
+                self.phases[phase] = [0, 0.0, 0.0, [0] * len(self.buckets)]
+            stat = self.phases[phase]
+            stat[0] += 1
+            stat[1] += seconds
+            stat[2] = max(stat[2], seconds)
+            for i in range(len(self.buckets)):
+                if seconds <= self.buckets[i]:
+                    stat[3][i] += 1
+                    break
+        for callback in self.callbacks:
+            callback(phase, seconds)
+
+    def count(self, name, value=1):
+        if self.enabled is False:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def caches(self):
+        # (name, hits, misses) of the geolocation and DNS caches
+        result = []
+        for name, cache in (('geo', geo_cache), ('dns', reverse_resolver.names)):
+            info = cache.info()
+            result.append((name, info.hits + self.worker_caches[name][0], info.misses + self.worker_caches[name][1]))
+        return result
+
+    def state(self):
+        # A copy of the phases, counters and cache statistics that can be sent to another process and merged there
+        with self.lock:
+            return ([(phase, [stat[0], stat[1], stat[2], list(stat[3])]) for phase, stat in self.phases.items()], list(self.counters.items()), self.caches())
+
+    def merge(self, state):
+        phases, counters, caches = state
+        for name, hits, misses in caches:
+            self.worker_caches[name][0] += hits
+            self.worker_caches[name][1] += misses
+        with self.lock:
+            for phase, stat in phases:
+                if phase not in self.phases:
+                    self.phases[phase] = [0, 0.0, 0.0, [0] * len(self.buckets)]
+                merged = self.phases[phase]
+                merged[0] += stat[0]
+                merged[1] += stat[1]
+                merged[2] = max(merged[2], stat[2])
+                merged[3] = [a + b for a, b in zip(merged[3], stat[3])]
+            for name, value in counters:
+                self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        lines = ["{:<12} {:>10} {:>12} {:>12} {:>12}".format('phase', 'count', 'total (s)', 'mean (ms)', 'max (ms)')]
+        for phase, stat in self.phases.items():
+            lines.append("{:<12} {:>10} {:>12.3f} {:>12.3f} {:>12.3f}".format(phase, stat[0], stat[1], stat[1] * 1000 / stat[0], stat[2] * 1000))
+        lines.append('')
+        for name, value in self.counters.items():
+            lines.append("{:<24} {}".format(name, value))
+        for name, hits, misses in self.caches():
+            lines.append("{:<24} {} hits, {} misses".format(name + ' cache', hits, misses))
+        return '\n'.join(lines) + '\n'
+
+    def prometheus(self):
+        # The metrics in the Prometheus text exposition format
+        lines = ["# HELP ip2trace_phase_seconds Time spent in each phase of the traces.", "# TYPE ip2trace_phase_seconds histogram"]
+        for phase, stat in self.phases.items():
+            cumulative = 0
+            for bucket, count in zip(self.buckets, stat[3]):
+                cumulative += count
+                lines.append('ip2trace_phase_seconds_bucket{{phase="{}",le="{}"}} {}'.format(phase, bucket, cumulative))
+            lines.append('ip2trace_phase_seconds_bucket{{phase="{}",le="+Inf"}} {}'.format(phase, stat[0]))
+            lines.append('ip2trace_phase_seconds_sum{{phase="{}"}} {}'.format(phase, stat[1]))
+            lines.append('ip2trace_phase_seconds_count{{phase="{}"}} {}'.format(phase, stat[0]))
+        for name, value in self.counters.items():
+            lines.append("# TYPE ip2trace_{}_total counter".format(name))
+            lines.append("ip2trace_{}_total {}".format(name, value))
+        caches = self.caches()
+        lines.append("# TYPE ip2trace_cache_hits_total counter")
+        for name, hits, misses in caches:
+            lines.append('ip2trace_cache_hits_total{{cache="{}"}} {}'.format(name, hits))
+        lines.append("# TYPE ip2trace_cache_misses_total counter")
+        for name, hits, misses in caches:
+            lines.append('ip2trace_cache_misses_total{{cache="{}"}} {}'.format(name, misses))
+        return '\n'.join(lines) + '\n'
+
+timeout_policy = TimeoutPolicy()
+probe_rate = RateLimiter()
+metrics = Metrics()
+if hasattr(os, 'register_at_fork'):
+    # The resolver threads do not survive a fork
+    os.register_at_fork(after_in_child=reverse_resolver.reset)
+
 def create_parser():
+    import argparse
     parser = argparse.ArgumentParser()
     # parser.add_argument('-p', '--ip', metavar='Specify an IP address or hostname.')
     gp = parser.add_mutually_exclusive_group()
@@ -118,6 +884,30 @@ def create_parser():
     parser.add_argument('-t', '--ttl', default=30, type=int, metavar='Set the max number of hops. (Default: 30)')
     parser.add_argument('-o', '--output', metavar='Specify the result columns to be output.', nargs='+')
     parser.add_argument('-a', '--all', action='store_true')
+    parser.add_argument('--parallel', action='store_true')
+    parser.add_argument('-f', '--targets-file', metavar='Specify a file with one IP address or hostname per line to trace in batch.')
+    parser.add_argument('-c', '--concurrency', default=100, type=int, metavar='Set the number of targets traced at once in batch mode. (Default: 100)')
+    parser.add_argument('--format', default='text', choices=['text', 'json', 'jsonl', 'ndjson', 'csv'], metavar='Set the output format: text, json, jsonl, ndjson or csv. (Default: text)')
+    parser.add_argument('--cache-size', default=4096, type=int, metavar='Set the number of IP2Location lookups kept in memory. (Default: 4096)')
+    parser.add_argument('--cache-ttl', type=float, metavar='Set the number of seconds a cached IP2Location lookup is kept. (Default: no expiry)')
+    parser.add_argument('-n', '--no-dns', action='store_true')
+    parser.add_argument('--dns-timeout', default=2.0, type=float, metavar='Set the number of seconds to wait for the hostname of a hop. (Default: 2)')
+    parser.add_argument('--timeout', default=500, type=float, metavar='Set the number of milliseconds to wait for the first hop. (Default: 500)')
+    parser.add_argument('--min-timeout', default=250, type=float, metavar='Set the shortest timeout in milliseconds. (Default: 250)')
+    parser.add_argument('--max-timeout', default=2000, type=float, metavar='Set the longest timeout in milliseconds. (Default: 2000)')
+    parser.add_argument('-r', '--rate', type=float, metavar='Set the max number of probes sent per second. (Default: no limit)')
+    parser.add_argument('-w', '--window', type=int, metavar='Set the number of hops probed at once in parallel mode. (Default: all hops)')
+    parser.add_argument('-M', '--method', default='icmp', choices=probe_methods, metavar='Set the probe method: icmp, udp or tcp. (Default: icmp)')
+    parser.add_argument('--port', type=int, metavar='Set the destination port of UDP and TCP probes. (Default: 33434 for udp, 80 for tcp)')
+    parser.add_argument('--flow-stable', action='store_true')
+    parser.add_argument('--multipath', nargs='?', const=8, type=int, metavar='Set the number of flows traced at once to find the load-balanced paths. (Default: 8)')
+    parser.add_argument('--path-cache', metavar='Specify an SQLite file to keep the last path to every destination in.')
+    parser.add_argument('--incremental', action='store_true')
+    parser.add_argument('--max-age', default=86400, type=float, metavar='Set the number of seconds after which --incremental traces a cached path in full again. (Default: 86400)')
+    parser.add_argument('--enrich', action='store_true')
+    parser.add_argument('--processes', nargs='?', const=0, type=int, metavar='Set the number of worker processes in batch mode. (Default: one per CPU core)')
+    parser.add_argument('--stats', action='store_true')
+    parser.add_argument('--prometheus', metavar='Specify a file to write the timing metrics to in the Prometheus text format.')
 
     return parser
 
@@ -143,6 +933,79 @@ def print_usage():
 "  -a, --all\n"
 "Print all the column(s) available based on the BIN file used.\n"
 "\n"
+"  --parallel\n"
+"  Send the probes for all hops at once and print the path when the replies are in.\n"
+"\n"
+"  --format\n"
+"  Set the output format. (Default: text)\n"
+"  text prints the traceroute as shown below, json prints one JSON object per trace, jsonl and ndjson print one JSON object per hop and csv prints one row per hop. The -o/--output and -a/--all column selection applies to every format.\n"
+"\n"
+"  --cache-size\n"
+"  Set the number of IP2Location lookups kept in memory and shared by all the traces. Use 0 to disable the cache. (Default: 4096)\n"
+"\n"
+"  --cache-ttl\n"
+"  Set the number of seconds a cached IP2Location lookup is kept. (Default: no expiry)\n"
+"\n"
+"  -n, --no-dns\n"
+"  Do not look up the hostname of the hops.\n"
+"\n"
+"  --dns-timeout\n"
+"  Set the number of seconds to wait for the hostname of a hop. Hostnames are looked up in the background while probing continues. (Default: 2)\n"
+"\n"
+"  --timeout\n"
+"  Set the number of milliseconds to wait for the replies to the first hop. The following hops wait for a timeout derived from the round trip times seen so far. (Default: 500)\n"
+"\n"
+"  --min-timeout, --max-timeout\n"
+"  Set the shortest and the longest timeout in milliseconds. (Default: 250 and 2000)\n"
+"\n"
+"  -r, --rate\n"
+"  Set the max number of probes sent per second. The probes are spaced out evenly, also within the windows of the parallel and batch modes. (Default: no limit)\n"
+"\n"
+"  -w, --window\n"
+"  Set the number of hops probed at once in parallel mode. (Default: all hops)\n"
+"\n"
+"  -M, --method\n"
+"  Set the probe method. icmp sends ICMP echo requests, udp sends UDP datagrams and tcp sends TCP SYN packets, which can get through firewalls that drop the others. (Default: icmp)\n"
+"\n"
+"  --port\n"
+"  Set the destination port of the UDP and TCP probes. (Default: 33434 for udp, 80 for tcp)\n"
+"\n"
+"  --flow-stable\n"
+"  Keep the ICMP checksum the same for every probe, so that load-balancing routers send all the probes of the trace along one path (as Paris traceroute does). UDP and TCP probes always keep their ports and are flow-stable.\n"
+"\n"
+"  --multipath [FLOWS]\n"
+"  Trace the destination over several flow-stable flows at once and print every interface answering at each hop. (Default: 8 flows)\n"
+"\n"
+"  --path-cache\n"
+"  Specify an SQLite file to keep the last path to every destination in. Each trace is compared with the last one and the changed hops are printed.\n"
+"\n"
+"  --incremental\n"
+"  With --path-cache, first probe the last two hops of the cached path once each and only trace the whole path again when they have changed.\n"
+"\n"
+"  --max-age\n"
+"  Set the number of seconds after which --incremental traces a cached path in full again, since the middle hops are not checked. (Default: 86400)\n"
+"\n"
+"  --enrich\n"
+"  Add the distance in km from the previous located hop (distance_km) and whether the round trip times allow the locations at the speed of light in fibre (rtt_plausible) to every hop. Needs a BIN database with latitude and longitude (DB5 or above).\n"
+"\n"
+"  --processes [PROCESSES]\n"
+"  Share the targets of the batch mode out between worker processes. The results are still printed in the order of the targets file, and -c/--concurrency and -r/--rate apply to all the workers together. (Default: one per CPU core)\n"
+"\n"
+"  --stats\n"
+"  Print the time spent sending probes, waiting for and parsing replies, resolving hostnames, geolocating and writing the output to standard error at exit, with the probe counters and the cache hit rates.\n"
+"\n"
+"  --prometheus\n"
+"  Write the same metrics to a file in the Prometheus text format at exit, for example for the node exporter textfile collector.\n"
+"\n"
+"  -f, --targets-file\n"
+"  Specify a file with one IP address or hostname per line (or - for standard input) to trace in batch. Results are printed as each trace completes.\n"
+"\n"
+"  -c, --concurrency\n"
+"  Set the number of targets traced at once in batch mode. (Default: 100)\n"
+"\n"
+"  --install-db\n"
+"  Copy the IP2Location LITE DB1 database shipped with ip2tracepy to /usr/local/share/ip2location/ for Linux or C:\\Users\\(your_Windows_username)\\Documents\\ for Windows, where it is used when -d/--database is not given. Needs root or administrator permission.\n"
+"\n"
 "  -h, -?, --help\n"
 "  Display this guide.\n"
 "\n"
@@ -155,289 +1018,1169 @@ def print_version():
 "Copyright (c) 2021 - 2024 IP2Location.com [MIT License]\n"
 "https://www.ip2location.com/free/traceroute-application\n")
 
-def traceroute(destination_server, database, ttl, output, all):
-    t = Traceroute(destination_server, database, ttl, output, all)
-    t.start_traceroute()
+def traceroute(destination_server, database, ttl, output, all, parallel=False, window=None, format='text', method='icmp', port=None, flow_stable=False, flows=None, path_cache=None, incremental=False, enrich=False):
+    if flows is not None:
+        traces = traceroute_multipath(destination_server, database, ttl, output, all, flows, window, method, port, enrich)
+        if len(traces) == 0:
+            return
+        writer = create_writer(format)
+        writer.start_trace(traces[0])
+        for hop in merge_paths(traces):
+            writer.write_hop(traces[0], hop)
+        writer.end_trace(traces[0])
+        return
+    if path_cache is None:
+        t = Traceroute(destination_server, database, ttl, output, all, parallel, window, method, port, flow_stable, None, False, enrich)
+        t.start_traceroute(create_writer(format))
+        return
+    path_cache = PathCache(path_cache)
+    try:
+        t = Traceroute(destination_server, database, ttl, output, all, parallel, window, method, port, flow_stable, path_cache.get(destination_server, method), incremental and path_cache.fresh(destination_server, method), enrich)
+        t.start_traceroute(create_writer(format, previous_ip=True))
+        path_cache.put(t)
+    finally:
+        path_cache.close()
+
+def create_writer(format, stream=None, previous_ip=False):
+    if stream is None:
+        stream = sys.stdout
+    if format == 'text':
+        return TextWriter()
+    elif format == 'json':
+        return JsonWriter(stream)
+    elif format in ('jsonl', 'ndjson'):
+        return JsonLinesWriter(stream)
+    elif format == 'csv':
+        return CsvWriter(stream, previous_ip)
+    print("The output format is invalid. Please use text, json, jsonl, ndjson or csv.")
+    sys.exit()
+
+def hop_to_dict(t, hop):
+    record = {'destination': t.destination_server, 'destination_ip': t.destination_ip, 'ttl': hop.ttl, 'ip': hop.ip, 'hostname': hop.hostname, 'rtts': [round(rtt, 3) for rtt in hop.rtts]}
+    if t.cached_path is not None:
+        record['previous_ip'] = t.cached_path[hop.ttl - 1] if hop.ttl <= len(t.cached_path) else None
+    if hop.geo is not None:
+        record.update(hop.geo)
+    return record
+
+class TextWriter:
+    # The human readable output, printed hop by hop as before
+    def __init__(self):
+        self.first = True
+
+    def start_trace(self, t):
+        if self.first:
+            t.print_start()
+            self.first = False
+        else:
+            print()
+            t.print_destination()
+
+    def write_hop(self, t, hop):
+        t.print_hop(hop)
+
+    def end_trace(self, t):
+        if t.cached_path is not None:
+            print()
+            t.print_changes()
+        sys.stdout.flush()
+
+class JsonLinesWriter:
+    # One JSON object per hop. Lines are buffered and written out once per trace.
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = []
+
+    def start_trace(self, t):
+        pass
+
+    def write_hop(self, t, hop):
+        self.buffer.append(json.dumps(hop_to_dict(t, hop)))
+        self.buffer.append('\n')
+
+    def end_trace(self, t):
+        self.stream.write(''.join(self.buffer))
+        self.stream.flush()
+        self.buffer = []
+
+class JsonWriter:
+    # One JSON object per trace, holding all its hops
+    def __init__(self, stream):
+        self.stream = stream
+        self.hops = []
+
+    def start_trace(self, t):
+        self.hops = []
+
+    def write_hop(self, t, hop):
+        record = hop_to_dict(t, hop)
+        del record['destination'], record['destination_ip']
+        self.hops.append(record)
+
+    def end_trace(self, t):
+        self.stream.write(json.dumps({'destination': t.destination_server, 'destination_ip': t.destination_ip, 'hops': self.hops}) + '\n')
+        self.stream.flush()
+        self.hops = []
+
+class CsvWriter:
+    # One row per hop. The header is written before the first trace and follows the -o/-a column selection.
+    # With a path cache, previous_ip holds the IP address of the hop in the last path, as in the JSON records.
+    def __init__(self, stream, previous_ip=False):
+        import csv
+        self.stream = stream
+        self.previous_ip = previous_ip
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\n')
+        self.columns = None
+
+    def start_trace(self, t):
+        if self.columns is None:
+            self.columns = t.output_columns()
+            self.writer.writerow(['destination', 'destination_ip', 'ttl', 'ip', 'hostname', 'rtts'] + (['previous_ip'] if self.previous_ip else []) + self.columns)
+
+    def write_hop(self, t, hop):
+        row = [t.destination_server, t.destination_ip, hop.ttl, hop.ip or '', hop.hostname or '', ' '.join('{:.3f}'.format(rtt) for rtt in hop.rtts)]
+        if self.previous_ip:
+            if t.cached_path is not None and hop.ttl <= len(t.cached_path):
+                row.append(t.cached_path[hop.ttl - 1] or '')
+            else:
+                row.append('')
+        for column in self.columns:
+            if hop.geo is not None and column in hop.geo:
+                row.append(hop.geo[column])
+            else:
+                row.append('')
+        self.writer.writerow(row)
+
+    def end_trace(self, t):
+        self.stream.write(self.buffer.getvalue())
+        self.stream.flush()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+
+class PathCache:
+    # The last path traced to every destination, kept in an SQLite file and keyed by destination and probe method
+    # updated is the time of the last full trace. Older paths are traced again in full even with incremental, since it only checks the last two hops.
+    max_age = 86400
+
+    def __init__(self, path):
+        import sqlite3
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS paths (destination TEXT, method TEXT, destination_ip TEXT, hops TEXT, updated REAL, PRIMARY KEY (destination, method))")
+        self.connection.commit()
+
+    def get(self, destination_server, method='icmp'):
+        # Returns the IP addresses of the hops, None for silent hops, or None when the destination has not been traced
+        row = self.connection.execute("SELECT hops FROM paths WHERE destination = ? AND method = ?", (destination_server, method)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0])
+
+    def fresh(self, destination_server, method='icmp'):
+        # Whether the last full trace to the destination is recent enough for the incremental check
+        row = self.connection.execute("SELECT updated FROM paths WHERE destination = ? AND method = ?", (destination_server, method)).fetchone()
+        return row is not None and time.time() - row[0] < self.max_age
+
+    def put(self, t):
+        if t.sent_error:
+            return
+        if t.path_reused:
+            # Only the last two hops were probed, so the cached path and its time stay as they are
+            return
+        self.connection.execute("INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?)", (t.destination_server, t.method, t.destination_ip, json.dumps(t.current_path()), time.time()))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+def print_unknown_host(destination_server):
+    # Reported on stderr so that the results on stdout stay machine readable
+    print("traceroute: unknown host {}".format(destination_server), file=sys.stderr)
+
+def traceroute_many(destination_servers, database, ttl, output, all, concurrency=100, window=None, method='icmp', port=None, flow_stable=False, path_cache=None, incremental=False, enrich=False, unknown_host=print_unknown_host):
+    # Traces many destinations at once over one shared socket per address family and yields each Traceroute once it completes and the PTR lookups of its hops are done.
+    # Completed traces are held back while the lookups run so that building their hops never blocks the loop, and the hops of the yielded traces only use names already looked up.
+    # With a PathCache, every trace is compared with (and with incremental, checked against) the last path to its destination, which is then replaced.
+    # unknown_host is called with every destination that does not resolve.
+    sockets = {}
+    tcp_sockets = {}
+    active = {}
+    # Completed traces waiting for their PTR lookups
+    finished = []
+    buffer = bytearray(1500)
+    destinations = DestinationResolver(destination_servers)
+    exhausted = False
+
+    def read_all_replies():
+        # Replies are handed to the trace owning the identifier
+        for reply_socket in list(sockets.values()) + list(tcp_sockets.values()):
+            for reply in read_replies(reply_socket, buffer, active, method):
+                active[reply[1]].record_reply(reply[0], reply[2], reply[3], reply[4])
+
+    try:
+        while True:
+            while exhausted is False and len(active) < concurrency:
+                # Only wait for a hostname when there is nothing else to do
+                destination = destinations.get(len(active) == 0 and len(finished) == 0)
+                if destination is None:
+                    break
+                if destination is False:
+                    exhausted = True
+                    break
+                destination_server, destination_ip = destination
+                if destination_ip is None:
+                    unknown_host(destination_server)
+                    continue
+                cached_path = path_cache.get(destination_server, method) if path_cache is not None else None
+                fresh = cached_path is not None and incremental and path_cache.fresh(destination_server, method)
+                t = Traceroute(destination_server, database, ttl, output, all, True, window, method, port, flow_stable, cached_path, fresh, enrich, destination_ip)
+                if t.family not in sockets:
+                    sockets[t.family] = open_icmp_socket(t.family)
+                    if method == 'tcp':
+                        tcp_sockets[t.family] = open_tcp_socket(t.family)
+                    if identifier_count < 0x10000 and sys.platform.startswith('linux') and method != 'udp':
+                        # The workers of traceroute_sharded only read the replies to their own identifiers. UDP probes are identified by ports the kernel picks, so they are not filtered.
+                        for reply_socket in (sockets[t.family], tcp_sockets.get(t.family)):
+                            if reply_socket is not None:
+                                attach_identifier_filter(reply_socket, method, *identifier_range(method))
+                t.open_sockets(sockets[t.family], tcp_sockets.get(t.family))
+                active[t.identifier] = t
+            if len(active) == 0 and len(finished) == 0:
+                break
+            now = timer()
+            # Read every reply that arrived before now first, so that no window is expired while its replies are still queued in a socket
+            read_all_replies()
+            for identifier, t in list(active.items()):
+                if t.window_done(now):
+                    if t.send_window() is False:
+                        del active[identifier]
+                        t.close_sockets()
+                        if path_cache is not None:
+                            path_cache.put(t)
+                        t.record_trace()
+                        finished.append(t)
+                        continue
+                elif len(t.unsent) > 0 and t.next_send_time <= now:
+                    t.send_due()
+                else:
+                    continue
+                # Replies from nearby hops come back while the pass is still sending, read them before they fill up the receive buffer
+                read_all_replies()
+            for t in [t for t in finished if t.names_ready()]:
+                finished.remove(t)
+                t.wait_for_names = False
+                yield t
+            if len(active) == 0 and len(finished) == 0:
+                continue
+            if len(active) > 0:
+                time_limit = min(t.wake_time() for t in active.values())
+            else:
+                time_limit = timer() + 0.01
+            if len(finished) > 0 or (exhausted is False and len(active) < concurrency and destinations.pending()):
+                # Look again soon for PTR names and destinations that have been resolved in the meantime
+                time_limit = min(time_limit, timer() + 0.01)
+            # The replies are read at the top of the loop
+            wait_time = timer()
+            select.select(list(sockets.values()) + list(tcp_sockets.values()), [], [], max(time_limit - wait_time, 0))
+            metrics.observe('wait', timer() - wait_time)
+    finally:
+        destinations.close()
+        for t in active.values():
+            t.close_sockets()
+        for shared_socket in list(sockets.values()) + list(tcp_sockets.values()):
+            shared_socket.close()
+
+def traceroute_multipath(destination_server, database, ttl, output, all, flows=8, window=None, method='icmp', port=None, enrich=False):
+    # Traces the destination over several flows at once. Every flow sends flow-stable probes with its own identifier (its own source port for UDP and TCP), so each one follows one of the paths of the load balancers on the way.
+    # Returns one Traceroute per flow.
+    if flows < 1:
+        print("The number of flows must be at least 1.")
+        sys.exit()
+    return list(traceroute_many([destination_server] * flows, database, ttl, output, all, flows, window, method, port, True, None, False, enrich))
+
+def merge_paths(traces):
+    # Returns the Hops of flow-stable traces to the same destination, with one Hop per distinct interface of a TTL holding the RTTs of every flow through it
+    path = []
+    for ttl in range(1, max(t.path_length() for t in traces) + 1):
+        interfaces = OrderedDict()
+        for t in traces:
+            if ttl <= t.path_length() and ttl in t.responses:
+                for ip, delays in t.responses[ttl].items():
+                    interfaces.setdefault(ip, []).extend(delays)
+        if len(interfaces) == 0:
+            path.append(traces[0].make_hop(ttl, None, []))
+        for ip, delays in interfaces.items():
+            path.append(traces[0].make_hop(ttl, ip, delays))
+    return path
+
+def traceroute_sharded(destination_servers, database, ttl, output, all, processes=None, concurrency=100, window=None, method='icmp', port=None, flow_stable=False, path_cache=None, incremental=False, enrich=False):
+    # Shares the destinations out between worker processes, each running traceroute_many on its shard, and yields (Traceroute, hops) in the input order.
+    # The hops are looked up in the workers, so that packet parsing, DNS and geolocation use every core. concurrency and the probe rate are for all the workers together.
+    import multiprocessing
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 1:
+        print("The number of processes must be at least 1.")
+        sys.exit()
+    targets = []
+    for destination_server in destination_servers:
+        destination_server = destination_server.strip()
+        if destination_server != '' and destination_server.startswith('#') is False:
+            targets.append((len(targets), destination_server))
+    # Map the BIN database before forking so that the workers share its pages. Forking is only safe on Linux, other platforms start new interpreters.
+    open_database(database)
+    if sys.platform.startswith('linux'):
+        context = multiprocessing.get_context('fork')
+    else:
+        context = multiprocessing.get_context()
+    results = context.Queue()
+    workers = []
+    for worker in range(processes):
+        # Round-robin shards keep every worker busy with the start of the list, so results can be written out in order early
+        process = context.Process(target=shard_worker, args=(results, worker, processes, targets[worker::processes], database, ttl, output, all, max(concurrency // processes, 1), window, method, port, flow_stable, path_cache, incremental, enrich, process_settings()))
+        process.daemon = True
+        process.start()
+        workers.append(process)
+    finished = {}
+    next_index = 0
+    running = processes
+    error = None
+    try:
+        while running > 0:
+            try:
+                index, t, hops = results.get(timeout=1)
+            except queue.Empty:
+                # A worker that died never says it is done
+                if any(process.is_alive() for process in workers) is False:
+                    break
+                continue
+            if index is None:
+                # The last message of a worker carries its metrics, and the error that stopped it if any
+                metrics.merge(t)
+                if hops is not None and error is None:
+                    error = hops
+                running -= 1
+                continue
+            finished[index] = (t, hops)
+            while next_index in finished:
+                t, hops = finished.pop(next_index)
+                next_index += 1
+                if t is not None:
+                    yield t, hops
+        for index in sorted(finished):
+            t, hops = finished[index]
+            if t is not None:
+                yield t, hops
+        if error is not None:
+            raise error
+    finally:
+        for process in workers:
+            if process.is_alive():
+                process.terminate()
+            process.join()
+
+def process_settings():
+    # The options kept in the module singletons, for worker processes started without fork
+    return {'rate': probe_rate.rate, 'timeouts': (timeout_policy.initial, timeout_policy.minimum, timeout_policy.maximum, timeout_policy.k), 'dns': (reverse_resolver.enabled, reverse_resolver.timeout), 'geo_cache': (geo_cache.maxsize, geo_cache.ttl), 'metrics': metrics.enabled, 'path_max_age': PathCache.max_age}
+
+def apply_process_settings(settings):
+    probe_rate.rate = settings['rate']
+    timeout_policy.initial, timeout_policy.minimum, timeout_policy.maximum, timeout_policy.k = settings['timeouts']
+    reverse_resolver.enabled, reverse_resolver.timeout = settings['dns']
+    geo_cache.maxsize, geo_cache.ttl = settings['geo_cache']
+    metrics.enabled = settings['metrics']
+    PathCache.max_age = settings['path_max_age']
+
+def shard_worker(results, worker, processes, shard, database, ttl, output, all, concurrency, window, method, port, flow_stable, path_cache, incremental, enrich, settings):
+    # Runs in a worker process of traceroute_sharded. Puts (index, Traceroute, hops) on results for every target of the shard, (index, None, None) for an unknown host and (None, metrics, error) when done.
+    apply_process_settings(settings)
+    set_identifier_range(worker * (0x10000 // processes), 0x10000 // processes)
+    if probe_rate.rate is not None:
+        probe_rate.rate = probe_rate.rate / float(processes)
+    positions = {}
+    for index, destination_server in shard:
+        positions.setdefault(destination_server, []).append(index)
+
+    def unknown_host(destination_server):
+        print_unknown_host(destination_server)
+        results.put((positions[destination_server].pop(0), None, None))
+
+    if path_cache is not None:
+        path_cache = PathCache(path_cache)
+    error = None
+    try:
+        for t in traceroute_many([destination_server for index, destination_server in shard], database, ttl, output, all, concurrency, window, method, port, flow_stable, path_cache, incremental, enrich, unknown_host):
+            t.destination_domain_name()
+            results.put((positions[t.destination_server].pop(0), t, t.get_path()))
+    except KeyboardInterrupt:  # handles Ctrl+C
+        pass
+    except (ValueError, PermissionError) as err:
+        # Raised again in the parent, which reports it once
+        error = err
+    finally:
+        if path_cache is not None:
+            path_cache.close()
+        results.put((None, metrics.state(), error))
+
+class AsyncTraceroute:
+    # Runs traces inside an asyncio event loop. One raw socket per address family (two for TCP probes) is watched with loop.add_reader, and the single reader hands every reply to the in-flight trace owning its identifier.
+    def __init__(self, database=None, ttl=30, output=None, all=False, window=None, method='icmp', port=None, flow_stable=False, enrich=False):
+        self.database = database
+        self.ttl = ttl
+        self.output = output
+        self.all = all
+        self.window = window
+        self.method = method
+        self.port = port
+        self.flow_stable = flow_stable
+        self.enrich = enrich
+        self.loop = None
+        self.sockets = {}
+        self.traces = {}
+        self.buffer = bytearray(1500)
+
+    async def trace(self, destination_server):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        # Resolving the destination and opening the BIN database block, so they run in the default executor
+        t = await loop.run_in_executor(None, Traceroute, destination_server, self.database, self.ttl, self.output, self.all, True, self.window, self.method, self.port, self.flow_stable, None, False, self.enrich)
+        t.open_sockets(self.get_socket(loop, (t.family, socket.IPPROTO_ICMP)), self.get_socket(loop, (t.family, socket.IPPROTO_TCP)) if self.method == 'tcp' else None)
+        window_complete = asyncio.Event()
+        self.traces[t.identifier] = (t, window_complete)
+        try:
+            while t.send_window():
+                # Wake up for the probes of the window still to be sent, and again when the time limit gets shorter because the destination answers
+                while t.window_done(timer()) is False:
+                    window_complete.clear()
+                    try:
+                        await asyncio.wait_for(window_complete.wait(), max(t.wake_time() - timer(), 0))
+                    except asyncio.TimeoutError:
+                        pass
+                    t.send_due()
+        finally:
+            del self.traces[t.identifier]
+            t.close_sockets()
+        t.record_trace()
+        # Wait for the PTR lookups started during probing without blocking the event loop
+        await loop.run_in_executor(None, t.get_path)
+        return t
+
+    def get_socket(self, loop, key):
+        # Sockets are keyed by address family and protocol
+        if self.loop is not loop:
+            self.close()
+            self.loop = loop
+        if key not in self.sockets:
+            if key[1] == socket.IPPROTO_TCP:
+                reply_socket = open_tcp_socket(key[0])
+            else:
+                reply_socket = open_icmp_socket(key[0])
+            reply_socket.setblocking(False)
+            loop.add_reader(reply_socket.fileno(), self.read_replies, reply_socket)
+            self.sockets[key] = reply_socket
+        return self.sockets[key]
+
+    def read_replies(self, reply_socket):
+        for reply in read_replies(reply_socket, self.buffer, self.traces, self.method):
+            t, window_complete = self.traces[reply[1]]
+            time_limit = t.time_limit
+            t.record_reply(reply[0], reply[2], reply[3], reply[4])
+            if len(t.probes) == 0 or t.time_limit < time_limit:
+                window_complete.set()
+
+    def close(self):
+        for reply_socket in self.sockets.values():
+            if self.loop is not None and self.loop.is_closed() is False:
+                self.loop.remove_reader(reply_socket.fileno())
+            reply_socket.close()
+        self.sockets = {}
+        self.loop = None
+
+async def traceroute_async(destination_server, database=None, ttl=30, output=None, all=False, window=None, method='icmp', port=None, flow_stable=False, enrich=False):
+    tracer = AsyncTraceroute(database, ttl, output, all, window, method, port, flow_stable, enrich)
+    try:
+        return await tracer.trace(destination_server)
+    finally:
+        tracer.close()
 
 class Traceroute:
-    def __init__(self, destination_server, database, max_hops, output, all):
+    def __init__(self, destination_server, database, max_hops, output, all, parallel=False, window=None, method='icmp', port=None, flow_stable=False, cached_path=None, incremental=False, enrich=False, destination_ip=None):
         self.destination_server = destination_server
         self.database = database
         self.max_hops = max_hops
         self.output = output
-        self.identifier = os.getpid() & 0xffff
+        self.identifier = next_identifier(method)
+        self.identifiers = (self.identifier,)
         self.seq_no = 0
+        self.packet_seq = 0
         self.delays = []
-        self.prev_sender_hostname = ""
         self.all = all
         self.family = None
+        self.icmp_socket = None
+        self.send_socket = None
+        self.reply_sockets = []
+        self.owned_sockets = []
+        self.method = method
+        self.port = port
+        self.flow_stable = flow_stable
+        # The IP addresses of the hops found by the last trace to the destination, None for silent hops
+        self.cached_path = cached_path
+        self.verifying = False
+        self.path_reused = False
+        # Whether building the hops waits for the PTR lookups still running. The batch engine only hands out traces whose lookups are done and clears it.
+        self.wait_for_names = True
+        # PTR name of the destination, None when it has none and False until it has been looked up
+        self.destination_name = False
+        self.enrich = enrich
+        # (latitude, longitude, lowest RTT) of the located hops by TTL, for --enrich
+        self.locations = {}
+        self.parallel = parallel
+        self.window = window
+        self.probes = {}
+        # TTLs of the probes of the window still to be sent, and the time booked with probe_rate for the next one
+        self.unsent = deque()
+        self.next_send_time = None
+        self.responses = {}
+        self.first_ttl = 1
+        self.last_ttl = max_hops
+        self.time_limit = None
+        self.sent_error = False
 
         self.count_of_packets = 1
         self.packet_size = 80
-        # self.timeout = 1000
-        self.timeout = 500
+        self.probes_per_hop = 3
+        self.buffer = bytearray(1500)
+        self.rtt_estimator = timeout_policy.estimator()
         self.ttl = 1
+        self.start_time = timer()
 
+        # Invalid options raise ValueError and an unknown host socket.gaierror, which main() prints. The asyncio engine and other callers get them as ordinary exceptions.
         if (destination_server is None):
-            print ("Missing IP address or hostname.")
-            sys.exit()
+            raise ValueError("Missing IP address or hostname.")
 
-        try:
-            self.destination_ip = to_ip(destination_server)
-            self.destination_domain_name = ip_to_domain_name(destination_server)
-        except socket.gaierror:
-            self.print_unknownhost()
-            sys.exit()
-
-        # Open up IP2Location BIN file
-        if (database is not None):
-            if os.path.isfile(database) == False:
-                # Now will check if the filename passed is a BIN extension or not
-                if database.upper().endswith(".BIN"):
-                    # check if the given filename is under current dir or not.
-                    if (os.getcwd().endswith(os.sep)):
-                        filepath = os.getcwd() + database
-                    else:
-                        filepath = os.getcwd() + os.sep + database
-                    # print(filepath)
-                    if os.path.isfile(filepath) == False:
-                        if os.path.isfile(default_path + database) == False:
-                            print("BIN database file not found.")
-                            sys.exit()
-                        else:
-                            self.obj = IP2Location.IP2Location(default_path + database)
-                    else:
-                        self.obj = IP2Location.IP2Location(filepath)
-                else:
-                    print("Only BIN database is accepted. You can download the latest free IP2Location BIN database from https://lite.ip2location.com.")
-                    sys.exit()
-            else:
-                self.obj = IP2Location.IP2Location(database)
+        if self.method not in probe_methods:
+            raise ValueError("The probe method must be icmp, udp or tcp.")
+        if self.port is None:
+            self.port = DEFAULT_TCP_PORT if self.method == 'tcp' else DEFAULT_UDP_PORT
+        elif self.port < 1 or self.port > 65535:
+            raise ValueError("The port must be between 1 and 65535.")
+        # UDP probes are told apart by their payload length, so fewer sequence numbers are available
+        self.seq_mask = 0x3ff if self.method == 'udp' else 0xffff
+
+        # The batch engine passes in the address it has resolved already
+        self.destination_ip = destination_ip if destination_ip is not None else to_ip(destination_server)
+        if is_valid_ip(destination_server):
+            # The name is only needed for the text output, look it up while probing
+            reverse_resolver.submit(destination_server)
+        if is_ipv4(self.destination_ip) == 4:
+            self.family = socket.AF_INET
         else:
-            if (os.path.isfile(default_path + "IP2LOCATION-LITE-DB1.IPV6.BIN") != False):
-                self.obj = IP2Location.IP2Location(default_path + "IP2LOCATION-LITE-DB1.IPV6.BIN")
-            else:
-                print("Missing IP2Location BIN database. Please enter 'ip2trace -h' for more information.")
-                sys.exit()
+            self.family = socket.AF_INET6
+        # SYN-ACKs and RSTs are only taken from this address
+        self.destination_packed = socket.inet_pton(self.family, self.destination_ip)
+        # Resolve the destination sockaddr once instead of for every probe
+        self.destination_address = socket.getaddrinfo(host=self.destination_ip, port=None, family=self.family, type=socket.SOCK_RAW)[0][4]
+        if self.method == 'udp':
+            self.destination_address = (self.destination_address[0], self.port) + tuple(self.destination_address[2:])
+
+        # Open up IP2Location BIN file, shared with every other trace in the process
+        self.database_path, self.obj = open_database(database)
 
         # check the output list
         if (self.output is not None):
             for i in self.output:
                 if i not in ip2location_outputs_reference:
-                    print("The column name is invalid. Please get a list of valid column names at https://www.ip2location.com/database/db26-ip-country-region-city-latitude-longitude-zipcode-timezone-isp-domain-netspeed-areacode-weather-mobile-elevation-usagetype-addresstype-category-district-asn.")
-                    sys.exit()
+                    raise ValueError("The column name is invalid. Please get a list of valid column names at https://www.ip2location.com/database/db26-ip-country-region-city-latitude-longitude-zipcode-timezone-isp-domain-netspeed-areacode-weather-mobile-elevation-usagetype-addresstype-category-district-asn.")
+            columns = self.output
+        elif (self.all is False):
+            columns = ['country_code', 'region_name', 'city_name']
+        else:
+            columns = ip2location_outputs_reference
+        # The -o/-a column selection, compiled once into (output column, record field) pairs in output order
+        self.projection = tuple((column, ip2location_output_fields[column]) for column in columns)
+
+        if (self.window is not None and self.window < 1):
+            raise ValueError("The window must be at least 1 hop.")
+
+        # The replies that end a trace: the echo reply, a SYN-ACK or RST from the destination, or a Destination Unreachable (the Port Unreachable answer to a UDP probe)
+        if self.family == socket.AF_INET:
+            self.final_types = (ICMP_ECHO_REPLY, ICMP_DEST_UNREACHABLE, TCP_RESPONSE)
+        else:
+            self.final_types = (ICMP_V6_ECHO_REPLY, ICMP_V6_DEST_UNREACHABLE, TCP_RESPONSE)
+
+        if incremental and cached_path is not None and 0 < len(cached_path) <= max_hops and cached_path[-1] == self.destination_ip:
+            # Probe the last two hops of the cached path once each, the whole path is traced again only when they have changed
+            self.verifying = True
+            self.first_ttl = max(len(cached_path) - 1, 1)
+            self.last_ttl = len(cached_path)
+            self.probes_per_hop = 1
+
+        self.build_probe_template()
+
+    def __getstate__(self):
+        # Traces sent back by worker processes keep their results, but not their sockets, buffers and database handle
+        state = self.__dict__.copy()
+        for name in ('icmp_socket', 'send_socket', 'obj', 'buffer', 'probe_packet'):
+            state[name] = None
+        state['reply_sockets'] = []
+        state['owned_sockets'] = []
+        return state
 
     def print_start(self):
         print("IP2Location Geolocation Traceroute (ip2trace) Version 3.2.0\n"
 "Copyright (c) 2021 - 2024 IP2Location.com [MIT License]\n"
 "https://www.ip2location.com/free/traceroute-application\n\n")
-        if self.destination_domain_name is not None:
-            print("Traceroute to", self.destination_domain_name[0], "(", self.destination_ip, ")\n\n", end="")
+        self.print_destination()
+
+    def destination_domain_name(self):
+        # PTR name of the destination when it was given as an IP address. Worker processes look it up before sending the trace back, so that the parent does not.
+        if self.destination_name is False:
+            if is_valid_ip(self.destination_server):
+                self.destination_name = reverse_resolver.resolve(self.destination_server, self.wait_for_names)
+            else:
+                self.destination_name = None
+        return self.destination_name
+
+    def print_destination(self):
+        destination_domain_name = self.destination_domain_name()
+        if destination_domain_name is not None:
+            print("Traceroute to", destination_domain_name, "(", self.destination_ip, ")\n\n", end="")
         else:
             print("Traceroute to", self.destination_ip, "\n\n", end="")
 
-    def print_unknownhost(self):
-        print("traceroute: unknown host {}".format(self.destination_server))
+    def print_changes(self):
+        changes = self.path_changes()
+        if len(changes) == 0:
+            print("Path unchanged since the last trace")
+            return
+        print("Path changed at {} hop(s) since the last trace".format(len(changes)))
+        for ttl, previous_ip, ip in changes:
+            print("{:>2}  {} -> {}".format(ttl, previous_ip or '*', ip or '*'))
 
-    def print_timeout(self):
-        if self.seq_no == 1:
-            if self.ttl < 10:
-                print(" {}  ".format(self.ttl), end="")
-            else:
-                print("{}  ".format(self.ttl), end="")
-        print("* ", end="")
-        if self.seq_no == self.count_of_packets:
-            print()
+    def print_hop(self, hop):
+        if hop.ttl < 10:
+            print(" {}  ".format(hop.ttl), end="")
+        else:
+            print("{}  ".format(hop.ttl), end="")
+        if hop.ip is None:
+            print("* ")
+            return
+        print("{}  ".format(hop.ip), end="")
+        for rtt in hop.rtts:
+            print("{:.3f}ms ".format(rtt), end="")
+        if hop.geo is not None:
+            print('[' + ','.join('"' + str(value) + '"' for value in hop.geo.values()) + ']', end="")
+        print()
 
-    # def print_trace(self, delay, ip_header):
-    def print_trace(self, delays, ip_header):
-        total_delays = 0
-        ip = socket.inet_ntoa(struct.pack('!I', ip_header['Source_IP']))
-        try:
-            sender_hostname = socket.gethostbyaddr(ip)[0]
-        except socket.herror:
-            sender_hostname = ip
-        if self.prev_sender_hostname != sender_hostname:
-            record = None
-            if is_valid_ip(ip):
+    def make_hop(self, ttl, ip, delays):
+        if ip is None:
+            if self.enrich:
+                self.locations.pop(ttl, None)
+            return Hop(ttl, None, (), None, None)
+        record = self.lookup(ip)
+        geo = self.project(record)
+        if self.enrich:
+            self.enrich_hop(ttl, record_location(record), delays, geo)
+        return Hop(ttl, ip, tuple(delays), reverse_resolver.resolve(ip, self.wait_for_names), geo)
+
+    def lookup(self, ip):
+        # Returns the IP2Location record of the IP address from the cache shared by every trace, None for invalid addresses
+        if is_valid_ip(ip) is False:
+            return None
+        record = geo_cache.get((self.database_path, ip))
+        if record is LookupCache.MISSING:
+            start_time = timer()
+            with database_locks[self.database_path]:
                 record = self.obj.get_all(ip)
-            if record is None:
-                if self.ttl < 10:
-                    # print(" {}  {}  {:.3f}ms ".format(self.ttl, ip, delay), end="")
-                    print(" {}  {}  ".format(self.ttl, ip), end="")
-                    for i in range(0, len(delays)):
-                        total_delays = total_delays + delays[i]
-                        print("{:.3f}ms ".format(delays[i]), end="")
-                else:
-                    # print("{}  {}  {:.3f}ms ".format(self.ttl, ip, delay), end="")
-                    # print("{}  {}  {:.3f}ms ".format(self.ttl, ip, delay), end="")
-                    print("{}  {}  ".format(self.ttl, ip), end="")
-                    for i in range(0, len(delays)):
-                        total_delays = total_delays + delays[i]
-                        print("{:.3f}ms ".format(delays[i]), end="")
-            else:
-                if self.ttl < 10:
-                    # print(" {}  {}  {:.3f}ms ".format(self.ttl, ip, delay), end="")
-                    # print(" {}  {}  {:.3f}ms ".format(self.ttl, ip, delay), end="")
-                    print(" {}  {}  ".format(self.ttl, ip), end="")
-                    for i in range(0, len(delays)):
-                        total_delays = total_delays + delays[i]
-                        print("{:.3f}ms ".format(delays[i]), end="")
-                else:
-                    # print("{}  {}  {:.3f}ms ".format(self.ttl, ip, delay), end="")
-                    # print("{}  {}  {:.3f}ms ".format(self.ttl, ip, delay), end="")
-                    print("{}  {}  ".format(self.ttl, ip), end="")
-                    for i in range(0, len(delays)):
-                        total_delays = total_delays + delays[i]
-                        print("{:.3f}ms ".format(delays[i]), end="")
-                display_result = '['
-                record_dict = {}
-                for attr, value in record.__dict__.items():
-                    record_dict[attr] = value
-                if (self.output is not None):
-                    for i in self.output:
-                        if (i in ip2location_outputs_reference) and (ip2location_result_fields[ip2location_outputs_reference.index(i)] in record_dict) and (record_dict[ip2location_result_fields[ip2location_outputs_reference.index(i)]] is not None):
-                            display_result = display_result + '"' + str(record_dict[ip2location_result_fields[ip2location_outputs_reference.index(i)]]) + '",'
+            metrics.observe('geolocation', timer() - start_time)
+            geo_cache.put((self.database_path, ip), record)
+        return record
+
+    def project(self, record):
+        # Returns the selected columns of the record in output order. Columns the BIN does not have are left out.
+        if record is None:
+            return None
+        record_dict = record.__dict__
+        geo = {}
+        for column, field in self.projection:
+            value = record_dict.get(field)
+            if value is not None:
+                geo[column] = value
+        return geo
+
+    def geolocate(self, ip):
+        # Returns the selected IP2Location columns of the IP address, keyed by their output column name
+        return self.project(self.lookup(ip))
+
+    def enrich_hop(self, ttl, location, delays, geo):
+        # Adds the distance in km from the nearest located hop before this one, and whether the RTTs allow the locations.
+        # Two routers with lowest RTTs a and b are at most (a + b) / 2 ms of fibre apart through the source, so a hop farther than that from any earlier hop has a wrong location (or an anycast address).
+        if location is None or geo is None:
+            self.locations.pop(ttl, None)
+            return
+        rtt = min(delays) if len(delays) > 0 else None
+        self.locations[ttl] = (location[0], location[1], rtt)
+        previous = [hop_ttl for hop_ttl in self.locations if hop_ttl < ttl]
+        if len(previous) == 0:
+            if rtt is not None:
+                geo['rtt_plausible'] = True
+            return
+        distances = [(distance_km(location, self.locations[hop_ttl]), self.locations[hop_ttl][2]) for hop_ttl in previous]
+        geo['distance_km'] = round(distances[previous.index(max(previous))][0], 1)
+        if rtt is not None:
+            geo['rtt_plausible'] = all(previous_rtt is None or distance <= (rtt + previous_rtt) * FIBRE_KM_PER_MS / 2 for distance, previous_rtt in distances)
+
+    def start_traceroute(self, writer=None):
+        if writer is None:
+            writer = TextWriter()
+        writer.start_trace(self)
+        try:
+            for hop in self.trace():
+                if metrics.enabled:
+                    start_time = timer()
+                    writer.write_hop(self, hop)
+                    metrics.observe('output', timer() - start_time)
                 else:
-                    if (self.all is False) :
-                        if "region" in record_dict:
-                            display_result = display_result + '"' + str(record_dict["country_short"]) + '","' + str(record_dict["region"]) + '","' + str(record_dict["city"]) + '"'
-                        else:
-                            display_result = display_result + '"' + str(record_dict["country_short"]) + '"'
-                    else :
-                        for i in range(0,len(ip2location_result_fields)):
-                            if (ip2location_result_fields[i] in record_dict) and (record_dict[ip2location_result_fields[i]] is not None):
-                                display_result = display_result + '"' + str(record_dict[ip2location_result_fields[i]]) + '",'
-                if display_result.endswith(','):
-                    display_result = display_result[:-1]
-                display_result = display_result + ']'
-                print("{}".format(display_result), end="")
-            self.prev_sender_hostname = sender_hostname
-        else:
-            print("{:.3f} ms ".format(delay), end="")
-        if self.seq_no == self.count_of_packets:
-            print()
-            self.prev_sender_hostname = ""
-            average_delays = total_delays / len(delays)
-            if MIN_SLEEP > average_delays:
-                time.sleep((MIN_SLEEP - average_delays) / 1000)
-
-    def header_to_dict(self, keys, packet, struct_format):
-        values = struct.unpack(struct_format, packet)
-        return dict(zip(keys, values))
-
-    def start_traceroute(self):
-        icmp_header = None
-        while self.ttl <= self.max_hops:
-            self.seq_no = 0
-            try:
-                for i in range(self.count_of_packets):
-                    icmp_header = self.tracer()
-            except KeyboardInterrupt:  # handles Ctrl+C
-                break
-            self.ttl += 1
-            if icmp_header is not None:
-                if is_ipv4(self.destination_ip) == 4 and icmp_header['type'] == ICMP_ECHO_REPLY:
+                    writer.write_hop(self, hop)
+        finally:
+            writer.end_trace(self)
+
+    def output_columns(self):
+        # Names of the IP2Location columns selected with -o/--output or -a/--all, then the --enrich columns
+        columns = [column for column, field in self.projection]
+        if self.enrich:
+            columns += enrichment_columns
+        return columns
+
+    def trace(self):
+        # Yields a Hop for every hop of the path as soon as it has been probed
+        if self.parallel or self.verifying:
+            for hop in self.trace_parallel():
+                yield hop
+            self.record_trace()
+            return
+        # The same sockets are used for every probe of the trace, only the TTL changes between hops
+        self.open_sockets()
+        # (ttl, ip, delays) of the probed hops whose PTR lookup is still running. They are yielded in order once it is done, while the next hops are probed.
+        probed = deque()
+        try:
+            while self.ttl <= self.max_hops:
+                try:
+                    hop_ip, delays, icmp_type = self.tracer()
+                except KeyboardInterrupt:  # handles Ctrl+C
+                    break
+                if delays is None:
                     break
-                elif is_ipv6(self.destination_ip) == 6 and icmp_header['type'] == ICMP_V6_ECHO_REPLY:
+                probed.append((self.ttl, hop_ip, delays))
+                # Keep the hops so that get_path() and the path cache also work after a sequential trace
+                if hop_ip is not None:
+                    self.responses[self.ttl] = OrderedDict([(hop_ip, list(delays))])
+                self.first_ttl = self.ttl + 1
+                if icmp_type in self.final_types:
+                    self.last_ttl = self.ttl
                     break
+                while len(probed) > 0 and reverse_resolver.ready(probed[0][1]):
+                    yield self.make_hop(*probed.popleft())
+                self.ttl += 1
+        finally:
+            self.close_sockets()
+        while len(probed) > 0:
+            yield self.make_hop(*probed.popleft())
+        self.record_trace()
 
-    def tracer(self):
-        self.seq_no += 1
-        if self.ttl == 1 and self.seq_no == 1:
-            self.print_start()
+    def record_trace(self):
+        # Called once the trace is complete. Probes still waiting for a reply have timed out.
+        metrics.count('traces')
+        metrics.count('timeouts', len(self.probes))
+        metrics.observe('trace', timer() - self.start_time)
+
+    def open_sockets(self, icmp_socket=None, tcp_socket=None):
+        # Replies always come back on an ICMP socket, plus the raw TCP socket for TCP probes. The batch and asyncio engines pass in their shared sockets, the others belong to the trace.
+        if icmp_socket is None:
+            icmp_socket = open_icmp_socket(self.family)
+            self.owned_sockets.append(icmp_socket)
+        self.icmp_socket = icmp_socket
+        self.reply_sockets = [icmp_socket]
+        if self.method == 'icmp':
+            self.send_socket = icmp_socket
+        elif self.method == 'udp':
+            # The source port picked by the kernel identifies the trace
+            self.send_socket = socket.socket(self.family, socket.SOCK_DGRAM)
+            self.owned_sockets.append(self.send_socket)
+            self.send_socket.bind(('0.0.0.0' if self.family == socket.AF_INET else '::', 0))
+            self.identifier = self.send_socket.getsockname()[1]
+            self.identifiers = (self.identifier,)
+        else:
+            if tcp_socket is None:
+                tcp_socket = open_tcp_socket(self.family)
+                self.owned_sockets.append(tcp_socket)
+            self.send_socket = tcp_socket
+            self.reply_sockets.append(tcp_socket)
 
+    def close_sockets(self):
+        for owned_socket in self.owned_sockets:
+            owned_socket.close()
+        self.owned_sockets = []
+
+    def tracer(self):
+        # Probes the current TTL. Returns the IP address that answered (None when the hop is silent), the RTTs and the type of the last reply, with the RTTs set to None when a probe could not be sent.
         delays = []
-        for i in range (0, 3):
-            try:
-                if is_ipv4(self.destination_ip) == 4:
-                    self.family = socket.AF_INET
-                    icmp_socket = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
-                    icmp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, self.ttl)
-                elif is_ipv6(self.destination_ip) == 6:
-                    self.family = socket.AF_INET6
-                    icmp_socket = socket.socket(socket.AF_INET6, socket.SOCK_RAW, socket.IPPROTO_ICMPV6)
-                    icmp_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_UNICAST_HOPS, self.ttl)
-                    if platform.system() == 'Linux':
-                        icmp_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_TCLASS, 0)
-            except socket.error as err:
-                if err.errno == 1:
-                    print("Operation not permitted: ICMP messages can only be sent from a process running as root")
-                else:
-                    print("Socket Error1: {}".format(err))
-                sys.exit()
-            sent_time = self.send_icmp_echo(icmp_socket)
+        hop_ip = None
+        icmp_type = None
+        self.set_ttl(self.send_socket, self.ttl)
+        for i in range (0, self.probes_per_hop):
+            probe_rate.wait()
+            self.packet_seq = (self.packet_seq + 1) & self.seq_mask
+            sent_time = self.send_probe(self.packet_seq)
             if sent_time is None:
-                return
-            receive_time, icmp_header, ip_header = self.receive_icmp_reply(icmp_socket)
-            icmp_socket.close()
+                return None, None, None
+            receive_time, reply_type, ip = self.receive_reply(self.packet_seq)
+            if receive_time is None:
+                metrics.count('timeouts')
             if receive_time:
+                metrics.count('replies')
                 delay = (receive_time - sent_time) * 1000.0
                 delays.append(delay)
-            time.sleep(0.005)
-        if len(delays) > 0 and ip_header is not None:
-            self.print_trace(delays, ip_header)
+                self.rtt_estimator.update(delay)
+                if hop_ip is None:
+                    reverse_resolver.submit(ip)
+                hop_ip = ip
+                icmp_type = reply_type
+        return hop_ip, delays, icmp_type
+
+    def trace_parallel(self):
+        self.open_sockets()
+        next_ttl = 1
+        try:
+            if self.send_window() is False:
+                return
+            while True:
+                wait_time = timer()
+                inputReady, _, _ = select.select(self.reply_sockets, [], [], max(self.wake_time() - wait_time, 0))
+                metrics.observe('wait', timer() - wait_time)
+                for reply_socket in inputReady:
+                    for reply in read_replies(reply_socket, self.buffer, self.identifiers, self.method):
+                        self.record_reply(reply[0], reply[2], reply[3], reply[4])
+                self.send_due()
+                if self.window_done(timer()):
+                    # The hops of a completed window will not change any more, once a cached path has been checked
+                    self.next_window_hops()
+                    for hop in self.get_path(next_ttl):
+                        yield hop
+                    next_ttl = self.path_length() + 1
+                    if self.send_window() is False:
+                        break
+        except KeyboardInterrupt:  # handles Ctrl+C
+            pass
+        finally:
+            self.close_sockets()
+
+    def next_window_hops(self):
+        # Every engine asks for the next window once the replies to the last one are in, which is when a cached path is checked
+        if self.verifying and self.sent_error is False and self.first_ttl > self.last_ttl:
+            self.verifying = False
+            if self.cached_path_holds():
+                self.path_reused = True
+                # The hops of the cached path are not probed again, so their names are looked up now
+                for ip in self.cached_path:
+                    if ip is not None:
+                        reverse_resolver.submit(ip)
+            else:
+                # The path has changed, trace it again from the first hop
+                self.responses.clear()
+                self.first_ttl = 1
+                self.last_ttl = self.max_hops
+                self.probes_per_hop = 3
+        if self.sent_error or self.first_ttl > self.last_ttl:
+            return 0
+        window = self.window if self.window is not None else self.max_hops
+        return min(window, self.last_ttl - self.first_ttl + 1)
+
+    def send_window(self):
+        # Starts the next window: its probes for every hop are sent before waiting for any reply, as fast as probe_rate allows. send_due() sends the rest when their time comes.
+        # Returns False once the destination is reached, the max number of hops has been probed or a probe could not be sent.
+        # Probes of the last window still waiting for a reply have timed out
+        metrics.count('timeouts', len(self.probes))
+        self.probes.clear()
+        window_hops = self.next_window_hops()
+        if window_hops == 0:
+            return False
+        window_end = self.first_ttl + window_hops - 1
+        for ttl in range(self.first_ttl, window_end + 1):
+            self.unsent.extend([ttl] * self.probes_per_hop)
+        self.first_ttl = window_end + 1
+        self.time_limit = timer() + self.rtt_estimator.timeout() / 1000
+        self.send_due()
+        return self.sent_error is False
+
+    def send_due(self):
+        # Sends the probes of the window whose time has come. Each probe is booked with probe_rate on its own, so that a window is paced probe by probe rather than sent as one burst.
+        ttl_set = None
+        while len(self.unsent) > 0:
+            if self.next_send_time is None:
+                delay = probe_rate.reserve()
+                if delay > 0:
+                    metrics.observe('rate_limit', delay)
+                self.next_send_time = timer() + delay
+            if self.next_send_time > timer():
+                return
+            self.next_send_time = None
+            ttl = self.unsent.popleft()
+            if ttl != ttl_set:
+                # Other traces sharing the socket set their own TTLs in between calls
+                self.set_ttl(self.send_socket, ttl)
+                ttl_set = ttl
+            self.packet_seq = (self.packet_seq + 1) & self.seq_mask
+            sent_time = self.send_probe(self.packet_seq)
+            if sent_time is None:
+                self.sent_error = True
+                self.unsent.clear()
+                return
+            self.probes[self.packet_seq] = (ttl, sent_time)
+            self.time_limit = max(self.time_limit, sent_time + self.rtt_estimator.timeout() / 1000)
+
+    def wake_time(self):
+        # When the engine has to come back to the trace: to send the next probe of the window, or when the window times out
+        if self.next_send_time is not None and len(self.unsent) > 0:
+            return min(self.next_send_time, self.time_limit)
+        return self.time_limit
+
+    def record_reply(self, icmp_type, seq_no, ip, receive_time):
+        # Replies are matched back to their hop by the sequence number of the probe
+        if seq_no not in self.probes or (icmp_type == TCP_RESPONSE and self.from_destination(ip) is False):
+            return
+        ttl, sent_time = self.probes.pop(seq_no)
+        metrics.count('replies')
+        # Every interface answering for the TTL is kept, in the order they first answered
+        if ttl not in self.responses:
+            self.responses[ttl] = OrderedDict()
+        if ip not in self.responses[ttl]:
+            self.responses[ttl][ip] = []
+            reverse_resolver.submit(ip)
+        delay = (receive_time - sent_time) * 1000.0
+        self.responses[ttl][ip].append(delay)
+        self.rtt_estimator.update(delay)
+        if icmp_type in self.final_types:
+            if ttl < self.last_ttl:
+                self.last_ttl = ttl
+            # Probes past the destination are not sent
+            while len(self.unsent) > 0 and self.unsent[-1] > self.last_ttl:
+                self.unsent.pop()
+            # Once the destination has answered, silent hops before it get one more timeout at most
+            self.time_limit = min(self.time_limit, receive_time + self.rtt_estimator.timeout() / 1000)
+
+    def from_destination(self, ip):
+        # Any host can send a SYN-ACK or RST to our source port, only those from the destination answer a probe. IPv6 link-local addresses come with a scope.
+        return socket.inet_pton(self.family, ip.split('%')[0]) == self.destination_packed
+
+    def cached_path_holds(self):
+        # The cached path still holds when the destination answers at the same distance and the hop before it has not changed
+        for ttl in range(max(len(self.cached_path) - 1, 1), len(self.cached_path) + 1):
+            ip = self.cached_path[ttl - 1]
+            if ip is not None and (ttl not in self.responses or ip not in self.responses[ttl]):
+                return False
+        return True
+
+    def current_path(self):
+        # The IP address of the first interface to answer at every hop, None for silent hops
+        path = []
+        for ttl in range(1, self.path_length() + 1):
+            if ttl in self.responses:
+                path.append(next(iter(self.responses[ttl])))
+            elif self.path_reused:
+                path.append(self.cached_path[ttl - 1])
+            else:
+                path.append(None)
+        return path
+
+    def path_changes(self):
+        # (ttl, previous IP address, IP address) for every hop that differs from the cached path
+        changes = []
+        current = self.current_path()
+        for ttl in range(1, max(len(current), len(self.cached_path)) + 1):
+            previous_ip = self.cached_path[ttl - 1] if ttl <= len(self.cached_path) else None
+            ip = current[ttl - 1] if ttl <= len(current) else None
+            if previous_ip != ip:
+                changes.append((ttl, previous_ip, ip))
+        return changes
+
+    def names_ready(self):
+        # True once the PTR lookups of every interface that answered, of the reused hops and of the destination given as an IP address are done or past their deadline
+        if is_valid_ip(self.destination_server) and reverse_resolver.ready(self.destination_server) is False:
+            return False
+        if self.path_reused and any(reverse_resolver.ready(ip) is False for ip in self.cached_path):
+            return False
+        return all(reverse_resolver.ready(ip) for interfaces in self.responses.values() for ip in interfaces)
+
+    def window_done(self, now):
+        if self.sent_error:
+            return True
+        return len(self.unsent) == 0 and (len(self.probes) == 0 or now >= self.time_limit)
+
+    def path_length(self):
+        # Number of hops probed so far, up to the destination
+        return min(self.last_ttl, self.first_ttl - 1)
+
+    def get_path(self, first_ttl=1):
+        # Returns the Hops collected by the parallel engine
+        path = []
+        for ttl in range(first_ttl, self.path_length() + 1):
+            if ttl in self.responses:
+                # The first interface to answer stands for the hop
+                interfaces = self.responses[ttl]
+                path.append(self.make_hop(ttl, next(iter(interfaces)), [delay for delays in interfaces.values() for delay in delays]))
+            elif self.path_reused:
+                # Hops of a cached path that still holds are not probed again
+                path.append(self.make_hop(ttl, self.cached_path[ttl - 1], []))
+            else:
+                path.append(self.make_hop(ttl, None, []))
+        return path
+
+    def print_path(self):
+        for hop in self.get_path():
+            self.print_hop(hop)
+
+    def set_ttl(self, send_socket, ttl):
+        if self.family == socket.AF_INET:
+            send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
         else:
-            self.print_timeout()
-        return icmp_header
+            send_socket.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_UNICAST_HOPS, ttl)
 
     def random_byte_message(self, size):
         '''
         Generate a random byte sequence of the specified size.
         '''
+        from random import choices
         sequence = choices(
             b'abcdefghijklmnopqrstuvwxyz'
             b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
             b'1234567890', k=size)
         return bytearray(sequence)
 
-    def send_icmp_echo(self, icmp_socket):
+    def build_probe_template(self):
+        # The probe is built and checksummed once per trace with a zero sequence number, then only the sequence number and checksum change per probe
+        if self.method == 'udp':
+            # UDP probes carry zeros and their payload length is the sequence number, the kernel fills in the UDP header
+            self.probe_packet = memoryview(bytearray(self.seq_mask))
+            return
+        if self.method == 'tcp':
+            # A bare SYN from the identifier as source port. The checksum covers the pseudo header, so it needs the source address the kernel will send from.
+            self.probe_packet = bytearray(tcp_header.pack(self.identifier, self.port, 0, 0, 5 << 4, TCP_SYN, 65535, 0, 0))
+            source = socket.inet_pton(self.family, source_address(self.family, (self.destination_ip, self.port)))
+            destination = socket.inet_pton(self.family, self.destination_ip)
+            if self.family == socket.AF_INET:
+                pseudo_header = source + destination + struct.pack("!BBH", 0, socket.IPPROTO_TCP, len(self.probe_packet))
+            else:
+                pseudo_header = source + destination + struct.pack("!IxxxB", len(self.probe_packet), socket.IPPROTO_TCP)
+            self.probe_checksum = calculate_checksum(pseudo_header + bytes(self.probe_packet))
+            return
         start_value = 65
         payload = []
-        if is_ipv4(self.destination_ip) == 4:
-            header = struct.pack("!BBHHH", ICMP_ECHO, 0, 0, self.identifier, self.seq_no)
-            # header = struct.pack("!2B3H", ICMP_ECHO, 0, 0, self.identifier, self.seq_no)
+        if self.family == socket.AF_INET:
+            self.probe_type = ICMP_ECHO
             for i in range(start_value, start_value+self.packet_size):
                 payload.append(i & 0xff)
             data = bytearray(payload)
-        elif is_ipv6(self.destination_ip) == 6:
-            header = struct.pack("!BBHHH", ICMP_V6_ECHO, 0, 0, self.identifier, self.seq_no)
-            # header = struct.pack("!2B3H", ICMP_V6_ECHO, 0, 0, self.identifier, self.seq_no)
+        else:
+            self.probe_type = ICMP_V6_ECHO
             data = self.random_byte_message(56)
-        checksum = calculate_checksum(header + data)
-        if is_ipv4(self.destination_ip) == 4:
-            header = struct.pack("!BBHHH", ICMP_ECHO, 0, checksum, self.identifier, self.seq_no)
-            # header = struct.pack("!2B3H", ICMP_ECHO, 0, checksum, self.identifier, self.seq_no)
-        elif is_ipv6(self.destination_ip) == 6:
-            header = struct.pack("!BBHHH", ICMP_V6_ECHO, 0, checksum, self.identifier, self.seq_no)
-            # header = struct.pack("!2B3H", ICMP_V6_ECHO, 0, checksum, self.identifier, self.seq_no)
-        packet = header + data
+        if self.flow_stable:
+            # The payload starts with the complement of the sequence number (0xffff for 0), so that the checksum stays the same for every probe
+            data[0:2] = b'\xff\xff'
+        self.probe_packet = bytearray(echo_header.pack(self.probe_type, 0, 0, self.identifier, 0)) + data
+        self.probe_checksum = calculate_checksum(self.probe_packet)
+
+    def send_probe(self, seq_no):
+        # Sends the probe with the sequence number through the socket of the probe method and returns the time it was sent
+        if self.method == 'icmp':
+            return self.send_icmp_echo(self.send_socket, seq_no)
+        if self.method == 'udp':
+            packet = self.probe_packet[:seq_no]
+        else:
+            # Sequence numbers fit in the low 16 bits of the TCP sequence number, so only that word of the checksum changes
+            struct.pack_into("!I", self.probe_packet, 4, seq_no)
+            struct.pack_into("!H", self.probe_packet, 16, update_checksum(self.probe_checksum, 0, seq_no))
+            packet = self.probe_packet
+        send_time = timer()
+        try:
+            self.send_socket.sendto(packet, self.destination_address)
+        except socket.error as err:
+            print("Socket Error2: {}".format(err), file=sys.stderr)
+            return
+        if metrics.enabled:
+            metrics.count('probes')
+            metrics.observe('send', timer() - send_time)
+        return send_time
+
+    def send_icmp_echo(self, icmp_socket, seq_no):
+        if self.flow_stable:
+            # Load balancers hash the ICMP checksum like the ports of UDP and TCP, so a constant checksum keeps every probe on one path (Paris traceroute)
+            echo_header.pack_into(self.probe_packet, 0, self.probe_type, 0, self.probe_checksum, self.identifier, seq_no)
+            struct.pack_into("!H", self.probe_packet, echo_header.size, ~seq_no & 0xffff)
+        else:
+            echo_header.pack_into(self.probe_packet, 0, self.probe_type, 0, update_checksum(self.probe_checksum, 0, seq_no), self.identifier, seq_no)
         send_time = timer()
         try:
             # icmp_socket.sendto(packet, (self.destination_ip, 0))
-            icmp_socket.sendto(packet, ((socket.getaddrinfo(host=self.destination_ip,port=None,family=self.family,type=socket.SOCK_RAW)[0][4])))
+            icmp_socket.sendto(self.probe_packet, self.destination_address)
         except socket.error as err:
-            print("Socket Error2: %s", err)
-            icmp_socket.close()
+            print("Socket Error2: {}".format(err), file=sys.stderr)
             return
+        if metrics.enabled:
+            metrics.count('probes')
+            metrics.observe('send', timer() - send_time)
         return send_time
 
-    def receive_icmp_reply(self, icmp_socket):
-        timeout = self.timeout / 1000
+    def receive_reply(self, seq_no):
+        timeout = self.rtt_estimator.timeout() / 1000
         time_limit = timer() + timeout
         while True:
-            inputReady, _, _ = select.select([icmp_socket], [], [], timeout)
-            receive_time = timer()
-            if receive_time > time_limit:  # timeout
+            wait_time = timer()
+            inputReady, _, _ = select.select(self.reply_sockets, [], [], max(time_limit - wait_time, 0))
+            metrics.observe('wait', timer() - wait_time)
+            if not inputReady or timer() > time_limit:  # timeout
                 # self.print_timeout()
                 return None, None, None
-            packet_data, address = icmp_socket.recvfrom(1024)
-            icmp_keys = ['type', 'code', 'checksum', 'identifier', 'sequence number']
-            icmp_header = self.header_to_dict(icmp_keys, packet_data[20:28], "!BBHHH")
-            ip_keys = ['VersionIHL', 'Type_of_Service', 'Total_Length', 'Identification', 'Flags_FragOffset', 'TTL', 'Protocol', 'Header_Checksum', 'Source_IP', 'Destination_IP']
-            ip_header = self.header_to_dict(ip_keys, packet_data[:20], "!BBHHHBBHII")
-            # print ("Source_IP1", ip_header['Source_IP'])
-            return receive_time, icmp_header, ip_header
+            reply = read_reply(inputReady[0], self.buffer, self.identifiers, self.method)
+            # The sockets are kept open across probes, so late replies to earlier probes must be skipped
+            if reply is None or reply[2] != seq_no or (reply[0] == TCP_RESPONSE and self.from_destination(reply[3]) is False):
+                continue
+            return reply[4], reply[0], reply[3]
+
+def batch_traceroute(targets_file, database, ttl, output, all, concurrency, window, format='text', method='icmp', port=None, flow_stable=False, path_cache=None, incremental=False, processes=None, enrich=False):
+    if concurrency < 1:
+        print("The concurrency must be at least 1.")
+        sys.exit()
+    if targets_file == '-':
+        targets = sys.stdin
+    elif os.path.isfile(targets_file):
+        targets = open(targets_file, 'r')
+    else:
+        print("Targets file not found.")
+        sys.exit()
+    writer = create_writer(format, previous_ip=path_cache is not None)
+    if processes is not None:
+        results = traceroute_sharded(targets, database, ttl, output, all, processes, concurrency, window, method, port, flow_stable, path_cache, incremental, enrich)
+        path_cache = None
+    else:
+        if path_cache is not None:
+            path_cache = PathCache(path_cache)
+        results = ((t, t.get_path()) for t in traceroute_many(targets, database, ttl, output, all, concurrency, window, method, port, flow_stable, path_cache, incremental, enrich))
+    try:
+        for t, hops in results:
+            start_time = timer()
+            writer.start_trace(t)
+            for hop in hops:
+                writer.write_hop(t, hop)
+            writer.end_trace(t)
+            metrics.observe('output', timer() - start_time)
+    except KeyboardInterrupt:  # handles Ctrl+C
+        pass
+    finally:
+        if targets is not sys.stdin:
+            targets.close()
+        if path_cache is not None:
+            path_cache.close()
 
 # if __name__ == '__main__':
 def main():
@@ -451,6 +2194,9 @@ def main():
             elif arg in ['--version', '-v']:
                 print_version()
                 is_help = True
+            elif arg == '--install-db':
+                install_database()
+                is_help = True
         if is_help is False:
             parser = create_parser()
             args = parser.parse_args(sys.argv[1:])
@@ -468,6 +2214,53 @@ def main():
             output = args.output
             # print(all)
             # sys.exit()
-            traceroute(destination_server, database, max_hops, output, all)
+            geo_cache.maxsize = args.cache_size
+            geo_cache.ttl = args.cache_ttl
+            reverse_resolver.enabled = args.no_dns is False
+            reverse_resolver.timeout = args.dns_timeout
+            if args.min_timeout <= 0 or args.min_timeout > args.max_timeout or args.timeout <= 0:
+                print("The timeouts must be positive and the min timeout cannot be above the max timeout.")
+                sys.exit()
+            timeout_policy.initial = args.timeout
+            timeout_policy.minimum = args.min_timeout
+            timeout_policy.maximum = args.max_timeout
+            if args.rate is not None and args.rate <= 0:
+                print("The rate must be above 0.")
+                sys.exit()
+            probe_rate.rate = args.rate
+            metrics.enabled = args.stats or args.prometheus is not None
+            if args.incremental and args.path_cache is None:
+                print("The incremental mode needs a path cache file.")
+                sys.exit()
+            if args.max_age < 0:
+                print("The max age cannot be below 0.")
+                sys.exit()
+            PathCache.max_age = args.max_age
+            if args.multipath is not None and (args.targets_file is not None or args.path_cache is not None):
+                print("The multipath mode traces a single destination without a path cache.")
+                sys.exit()
+            try:
+                if args.targets_file is not None:
+                    processes = args.processes
+                    if processes == 0:
+                        processes = os.cpu_count() or 1
+                    batch_traceroute(args.targets_file, database, max_hops, output, all, args.concurrency, args.window, args.format, args.method, args.port, args.flow_stable, args.path_cache, args.incremental, processes, args.enrich)
+                else:
+                    traceroute(destination_server, database, max_hops, output, all, args.parallel, args.window, args.format, args.method, args.port, args.flow_stable, args.multipath, args.path_cache, args.incremental, args.enrich)
+            except ValueError as err:
+                print(err)
+                sys.exit()
+            except socket.gaierror:
+                print("traceroute: unknown host {}".format(destination_server))
+                sys.exit()
+            except PermissionError as err:
+                print(err.strerror)
+                sys.exit()
+            finally:
+                if args.stats:
+                    sys.stderr.write(metrics.summary())
+                if args.prometheus is not None:
+                    with open(args.prometheus, 'w') as f:
+                        f.write(metrics.prometheus())
     else:
         print("Missing parameters. Please enter 'ip2trace -h' for more information.")
\ No newline at end of file